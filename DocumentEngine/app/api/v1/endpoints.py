@@ -1,22 +1,190 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
+import asyncio
+import math
+import os
+import time
+from typing import List, Optional
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Query, Request
+from fastapi.responses import FileResponse
+from pydantic import TypeAdapter, ValidationError
 from app.services.pipeline import DocumentPipeline
-from app.models.schema import DocumentResponse
+from app.services.ingestion import IngestionService
+from app.services.template_registry import template_registry
+from app.services.page_index import page_index
+from app.services.profiler import StageProfiler
+from app.services.admission import admission_controller, AdmissionRejected
+from app.services.stage_graph import StageFailedError, UnknownStageError
+from app.core.config import settings
+from app.models.schema import DocumentResponse, DocumentType, FormTemplateInfo, TemplateField
 from app.core.logging import logger
 
 router = APIRouter()
+# Profile inspection, only mounted when PROFILE_DEBUG_ENABLED is set
+debug_router = APIRouter()
+
+def _parse_stage_list(value: Optional[str]) -> List[str]:
+    return [name.strip() for name in value.split(",") if name.strip()] if value else []
+
+def _parse_deadline(request: Request) -> Optional[float]:
+    """Absolute deadline from the remaining-budget header, falling back to the configured default."""
+    value = request.headers.get(settings.DEADLINE_HEADER)
+    if value is not None:
+        try:
+            budget_ms = float(value)
+        except ValueError:
+            budget_ms = math.nan
+        # nan would make every deadline comparison False, so only a finite positive budget is accepted
+        if not math.isfinite(budget_ms) or budget_ms <= 0:
+            raise HTTPException(status_code=400, detail=f"Invalid {settings.DEADLINE_HEADER} header: {value}")
+        return time.time() + budget_ms / 1000
+    if settings.DEFAULT_REQUEST_DEADLINE_S > 0:
+        return time.time() + settings.DEFAULT_REQUEST_DEADLINE_S
+    return None
+
+@router.get("/stages")
+def list_stages_endpoint():
+    """
+    Lists the pipeline stages that can be enabled or disabled per request.
+    """
+    return {
+        "stages": [
+            {
+                "name": stage.name,
+                "depends_on": list(stage.depends_on),
+                "optional_depends_on": list(stage.optional_depends_on),
+                "required": stage.required,
+                "enabled_by_default": stage.enabled_by_default,
+                "timeout_s": stage.timeout_s
+            }
+            for stage in (DocumentPipeline.GRAPH.stages[name] for name in DocumentPipeline.GRAPH.order)
+        ]
+    }
 
 @router.post("/process", response_model=DocumentResponse)
-async def process_document_endpoint(file: UploadFile = File(...)):
+async def process_document_endpoint(
+    request: Request,
+    file: UploadFile = File(...),
+    enable: Optional[str] = Query(None, description="Comma-separated stages to enable (dependencies are pulled in)"),
+    disable: Optional[str] = Query(None, description="Comma-separated stages to disable (dependents are skipped)"),
+    dedup: bool = Query(True, description="Reuse the stored result if this page is a near-duplicate of an earlier scan")
+):
     """
     Upload an image document to be processed by the offline OCR engine.
     Returns structured JSON with layout, text, tables, and entities.
+    Send the `X-Profile: 1` header to capture a per-stage CPU/memory profile (when PROFILE_DEBUG_ENABLED
+    is set), and `X-Request-Deadline-Ms` to bound how long the engine may spend on the request.
+    Returns 503 (or 429 for the per-client limit) with Retry-After when the engine is saturated.
     """
     logger.info(f"Received request for file: {file.filename}")
+    profile = settings.PROFILE_DEBUG_ENABLED and \
+        request.headers.get(settings.PROFILE_HEADER, "").lower() in ("1", "true", "yes")
+    deadline = _parse_deadline(request)
+
+    ticket = None
+    if settings.ADMISSION_ENABLED:
+        client_id = request.headers.get(settings.CLIENT_ID_HEADER) or (request.client.host if request.client else "unknown")
+        try:
+            ticket = admission_controller.try_admit(client_id, IngestionService.peek_megapixels(file))
+        except AdmissionRejected as ar:
+            logger.warning(f"Shedding request for {file.filename}: {ar.reason}")
+            raise HTTPException(
+                status_code=ar.status_code, detail=ar.reason, headers={"Retry-After": str(ar.retry_after_s)}
+            )
+
+    completed = False
     try:
-        result = await DocumentPipeline.process_document(file)
+        result = await DocumentPipeline.process_document(
+            file,
+            enable_stages=_parse_stage_list(enable),
+            disable_stages=_parse_stage_list(disable),
+            dedup=dedup,
+            profile=profile,
+            deadline=deadline
+        )
+        completed = True
         return result
     except HTTPException as he:
         raise he
+    except UnknownStageError as ue:
+        raise HTTPException(status_code=400, detail=str(ue))
+    except StageFailedError as se:
+        if se.timed_out:
+            raise HTTPException(status_code=504, detail=f"Processing exceeded its time limit: {se}")
+        logger.error(f"Unhandled pipeline error: {se}")
+        raise HTTPException(status_code=500, detail="Internal Server Error during processing.")
     except Exception as e:
         logger.error(f"Unhandled pipeline error: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error during processing.")
+    finally:
+        if ticket is not None:
+            admission_controller.release(ticket, completed=completed)
+
+@router.get("/admission/stats")
+def admission_stats_endpoint():
+    """Current load and how many requests were admitted or shed."""
+    return admission_controller.stats()
+
+@router.get("/dedup/stats")
+def dedup_stats_endpoint():
+    """
+    Near-duplicate index statistics: hit rate, lookup latency percentiles and the
+    false-match rate measured on re-processed sample hits.
+    """
+    if page_index is None:
+        return {"enabled": False}
+    return {"enabled": True, **page_index.stats()}
+
+@debug_router.get("/debug/profiles")
+def list_profiles_endpoint(limit: int = Query(50, ge=1, le=1000)):
+    """Most recent stored request profiles."""
+    return {"profiles": StageProfiler.list_profiles(limit)}
+
+@debug_router.get("/debug/profiles/{profile_id}")
+def get_profile_endpoint(profile_id: str):
+    """
+    Stage breakdown of a profiled request: status, wall/CPU time, peak traced memory,
+    RSS delta and top functions for every stage.
+    """
+    summary = StageProfiler.load_summary(profile_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail=f"Profile not found: {profile_id}")
+    return summary
+
+@debug_router.get("/debug/profiles/{profile_id}/{stage}")
+def download_stage_profile_endpoint(profile_id: str, stage: str):
+    """Raw cProfile output of one stage, loadable with pstats or snakeviz."""
+    path = StageProfiler.stage_profile_path(profile_id, stage)
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=f"No profile for stage '{stage}' in {profile_id}")
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{profile_id}_{stage}.prof")
+
+@router.post("/templates", response_model=FormTemplateInfo)
+async def register_template_endpoint(
+    file: UploadFile = File(..., description="Blank or filled reference image of the form"),
+    name: str = Form(...),
+    fields: str = Form(..., description='JSON list of fields, e.g. [{"name": "invoice_no", "bbox": [x1, y1, x2, y2]}]'),
+    document_type: DocumentType = Form(DocumentType.FORM)
+):
+    """
+    Registers a form template. Matching pages are aligned to the reference image
+    and only the named field regions are OCR'd, returned as key_value blocks.
+    """
+    try:
+        parsed_fields = TypeAdapter(List[TemplateField]).validate_json(fields)
+    except ValidationError as ve:
+        raise HTTPException(status_code=400, detail=f"Invalid fields: {ve}")
+
+    image, _ = await IngestionService.process_upload(file)
+    try:
+        return await asyncio.to_thread(template_registry.register, name, image, parsed_fields, document_type)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+
+@router.get("/templates", response_model=List[FormTemplateInfo])
+def list_templates_endpoint():
+    return template_registry.list_templates()
+
+@router.delete("/templates/{template_id}")
+def delete_template_endpoint(template_id: str):
+    if not template_registry.remove(template_id):
+        raise HTTPException(status_code=404, detail=f"Template not found: {template_id}")
+    return {"deleted": template_id}
@@ -12,4 +12,48 @@ class Settings:
     DEFAULT_DPI: int = 300
     DEBUG_MODE: bool = False
 
+    # Pipeline Execution
+    PIPELINE_MAX_WORKERS: int = int(os.getenv("PIPELINE_MAX_WORKERS", "8"))
+    STAGE_TIMEOUT_S: float = float(os.getenv("STAGE_TIMEOUT_S", "30"))
+    OCR_TIMEOUT_S: float = float(os.getenv("OCR_TIMEOUT_S", "120"))
+
+    # Form Templates
+    # Empty keeps registered templates in memory only; set a directory to persist them across restarts
+    TEMPLATE_DIR: str = os.getenv("TEMPLATE_DIR", "")
+    TEMPLATE_MATCH_MAX_DIM: int = 1000      # Longest side pages are downscaled to for feature matching
+    TEMPLATE_ORB_FEATURES: int = 1500
+    TEMPLATE_MAX_CANDIDATES: int = 3        # Templates verified by homography after layout-hash ranking
+    TEMPLATE_MIN_INLIERS: int = int(os.getenv("TEMPLATE_MIN_INLIERS", "25"))
+
+    # Near-Duplicate Page Reuse
+    # Empty disables the index; results are only persisted to disk when a directory is configured
+    PAGE_INDEX_DIR: str = os.getenv("PAGE_INDEX_DIR", "")
+    DEDUP_SIMILARITY_THRESHOLD: float = float(os.getenv("DEDUP_SIMILARITY_THRESHOLD", "0.8"))
+    # Fraction of hits that are re-processed anyway to measure the false-match rate
+    DEDUP_VERIFY_SAMPLE_RATE: float = float(os.getenv("DEDUP_VERIFY_SAMPLE_RATE", "0.01"))
+
+    # On-Demand Profiling
+    # Requests are profiled when they are picked by the sampling rate (0 = off), or when they send
+    # PROFILE_HEADER and PROFILE_DEBUG_ENABLED is set. The latter also mounts the /debug/profiles routes.
+    # It is off by default: any client could otherwise slow the instance down and read code-level profiles.
+    PROFILE_SAMPLE_RATE: float = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+    PROFILE_DEBUG_ENABLED: bool = os.getenv("PROFILE_DEBUG_ENABLED", "0") == "1"
+    PROFILE_HEADER: str = "X-Profile"
+    PROFILE_DIR: str = os.getenv("PROFILE_DIR", "profiles")
+    PROFILE_TOP_FUNCTIONS: int = 20
+    # Oldest profiles beyond this count are deleted; 0 keeps all of them
+    PROFILE_MAX_STORED: int = int(os.getenv("PROFILE_MAX_STORED", "200"))
+
+    # Admission Control & Deadlines
+    ADMISSION_ENABLED: bool = os.getenv("ADMISSION_ENABLED", "1") == "1"
+    ADMISSION_MAX_IN_FLIGHT: int = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "16"))
+    # Estimated work admitted at once; a 300 DPI letter page is ~8.4 megapixels
+    ADMISSION_MAX_MEGAPIXELS: float = float(os.getenv("ADMISSION_MAX_MEGAPIXELS", "100"))
+    # Concurrent requests per client (X-Client-Id header, else remote address); 0 disables the limit
+    ADMISSION_PER_CLIENT_LIMIT: int = int(os.getenv("ADMISSION_PER_CLIENT_LIMIT", "0"))
+    CLIENT_ID_HEADER: str = "X-Client-Id"
+    # Remaining time budget in milliseconds, propagated to every stage and to Tesseract
+    DEADLINE_HEADER: str = "X-Request-Deadline-Ms"
+    DEFAULT_REQUEST_DEADLINE_S: float = float(os.getenv("DEFAULT_REQUEST_DEADLINE_S", "0"))
+
 settings = Settings()
@@ -1,7 +1,7 @@
 from fastapi import FastAPI
 from .core.config import settings
 from .core.logging import logger
-from .api.v1.endpoints import router as api_router
+from .api.v1.endpoints import router as api_router, debug_router
 
 def create_app() -> FastAPI:
     app = FastAPI(
@@ -12,6 +12,8 @@ def create_app() -> FastAPI:
     logger.info("Initializing Document Engine...")
 
     app.include_router(api_router, prefix=settings.API_V1_STR)
+    if settings.PROFILE_DEBUG_ENABLED:
+        app.include_router(debug_router, prefix=settings.API_V1_STR)
 
     @app.get("/health")
     def health_check():
@@ -18,6 +18,14 @@ class BlockType(str, Enum):
     IMAGE = "image"
     UNKNOWN = "unknown"
 
+class StageStatus(str, Enum):
+    OK = "ok"
+    FAILED = "failed"
+    TIMEOUT = "timeout"
+    SKIPPED = "skipped"
+    DISABLED = "disabled"
+    BYPASSED = "bypassed"
+
 # --- Shared Structures ---
 class BoundingBox(BaseModel):
     x1: int
@@ -31,7 +39,7 @@ class ConfidenceScore(BaseModel):
 # --- Content Components ---
 class Word(BaseModel):
     text: str
-    bbox: List[int] = Field(..., min_items=4, max_items=4, description="[x1, y1, x2, y2]")
+    bbox: List[int] = Field(..., min_length=4, max_length=4, description="[x1, y1, x2, y2]")
     confidence: float
 
 class Line(BaseModel):
@@ -78,6 +86,19 @@ class ExtractedEntities(BaseModel):
     emails: List[str] = []
     phones: List[str] = []
 
+# --- Form Templates ---
+class TemplateField(BaseModel):
+    name: str = Field(..., description="Key reported for this field")
+    bbox: List[int] = Field(..., min_length=4, max_length=4, description="[x1, y1, x2, y2] in reference image pixels")
+
+class FormTemplateInfo(BaseModel):
+    template_id: str
+    name: str
+    document_type: DocumentType = DocumentType.FORM
+    width: int
+    height: int
+    fields: List[TemplateField]
+
 # --- Metadata ---
 class ImageMetadata(BaseModel):
     width: int
@@ -86,6 +107,12 @@ class ImageMetadata(BaseModel):
     format: str
     color_space: str
 
+class StageReport(BaseModel):
+    name: str
+    status: StageStatus
+    runtime_ms: float = 0.0
+    error: Optional[str] = None
+
 class ProcessingMetadata(BaseModel):
     ocr_engine: str = "tesseract"
     model_type: str = "lstm"
@@ -93,6 +120,13 @@ class ProcessingMetadata(BaseModel):
     runtime_ms: float
     processed_offline: bool = True
     version: str = "1.0.0"
+    degraded: bool = Field(default=False, description="True if any pipeline stage failed, timed out or was skipped")
+    stages: List[StageReport] = []
+    template_id: Optional[str] = Field(default=None, description="Registered form template the page was matched to")
+    reused_from: Optional[str] = Field(default=None, description="document_id whose stored result was reused for this near-duplicate page")
+    dedup_similarity: Optional[float] = None
+    dedup_lookup_ms: Optional[float] = None
+    profile_id: Optional[str] = Field(default=None, description="Stored CPU/memory profile, see /debug/profiles/{profile_id}")
 
 class TextContent(BaseModel):
     full_text: str
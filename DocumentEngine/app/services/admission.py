@@ -0,0 +1,120 @@
+import math
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Any
+from app.core.config import settings
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed. Carries the HTTP status and a Retry-After hint in seconds."""
+
+    def __init__(self, reason: str, status_code: int, retry_after_s: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after_s = retry_after_s
+
+@dataclass
+class AdmissionTicket:
+    client_id: str
+    megapixels: float
+    admitted_at: float = field(default_factory=time.time)
+
+class AdmissionController:
+    """
+    Load shedding in front of the pipeline.
+    A request is admitted only while the number of in-flight requests and their total pixel count
+    (a proxy for OCR work) stay under the configured limits; otherwise it is rejected immediately,
+    so admitted requests finish in time instead of every request queueing until its client gives up.
+    """
+    EWMA_ALPHA = 0.2
+    MAX_RETRY_AFTER_S = 60
+
+    def __init__(self, max_in_flight: int, max_megapixels: float, per_client_limit: int = 0):
+        if max_in_flight <= 0 or max_megapixels <= 0:
+            # Both are divisors in the Retry-After estimate; ADMISSION_ENABLED=0 is the way to turn limits off
+            raise ValueError(f"Admission limits must be positive, got max_in_flight={max_in_flight}, "
+                             f"max_megapixels={max_megapixels}")
+        if per_client_limit < 0:
+            raise ValueError(f"per_client_limit must be 0 (no limit) or positive, got {per_client_limit}")
+        self.max_in_flight = max_in_flight
+        self.max_megapixels = max_megapixels
+        self.per_client_limit = per_client_limit
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._megapixels = 0.0
+        self._per_client: Dict[str, int] = {}
+        self._ewma_latency_s = 1.0
+
+        self._admitted = 0
+        self._rejected_overload = 0
+        self._rejected_client = 0
+
+    def try_admit(self, client_id: str, megapixels: float) -> AdmissionTicket:
+        """Reserves capacity for a request or raises AdmissionRejected."""
+        with self._lock:
+            if self.per_client_limit and self._per_client.get(client_id, 0) >= self.per_client_limit:
+                self._rejected_client += 1
+                raise AdmissionRejected(
+                    f"Client '{client_id}' already has {self.per_client_limit} requests in progress.",
+                    status_code=429,
+                    retry_after_s=self._retry_after()
+                )
+
+            over_depth = self._in_flight >= self.max_in_flight
+            # An idle engine always accepts one page, however large, otherwise it could never be processed
+            over_work = self._in_flight > 0 and self._megapixels + megapixels > self.max_megapixels
+            if over_depth or over_work:
+                self._rejected_overload += 1
+                raise AdmissionRejected(
+                    f"Engine saturated ({self._in_flight} requests, {self._megapixels:.1f} MP in progress).",
+                    status_code=503,
+                    retry_after_s=self._retry_after()
+                )
+
+            self._in_flight += 1
+            self._megapixels += megapixels
+            self._per_client[client_id] = self._per_client.get(client_id, 0) + 1
+            self._admitted += 1
+            return AdmissionTicket(client_id=client_id, megapixels=megapixels)
+
+    def release(self, ticket: AdmissionTicket, completed: bool = True):
+        """Returns the capacity held by an admitted request. Only completed requests update the latency estimate."""
+        with self._lock:
+            self._in_flight -= 1
+            self._megapixels = max(0.0, self._megapixels - ticket.megapixels)
+            remaining = self._per_client.get(ticket.client_id, 1) - 1
+            if remaining > 0:
+                self._per_client[ticket.client_id] = remaining
+            else:
+                self._per_client.pop(ticket.client_id, None)
+            if completed:
+                latency_s = time.time() - ticket.admitted_at
+                self._ewma_latency_s += AdmissionController.EWMA_ALPHA * (latency_s - self._ewma_latency_s)
+
+    def _retry_after(self) -> int:
+        # Roughly how long until the work already admitted drains, from the recent service time
+        load = max(self._in_flight / self.max_in_flight, self._megapixels / self.max_megapixels)
+        estimate = math.ceil(self._ewma_latency_s * max(load, 0.1))
+        return int(min(AdmissionController.MAX_RETRY_AFTER_S, max(1, estimate)))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": settings.ADMISSION_ENABLED,
+                "in_flight": self._in_flight,
+                "in_flight_megapixels": round(self._megapixels, 2),
+                "max_in_flight": self.max_in_flight,
+                "max_megapixels": self.max_megapixels,
+                "per_client_limit": self.per_client_limit,
+                "admitted": self._admitted,
+                "rejected_overload": self._rejected_overload,
+                "rejected_client_limit": self._rejected_client,
+                "ewma_latency_s": round(self._ewma_latency_s, 3)
+            }
+
+admission_controller = AdmissionController(
+    max_in_flight=settings.ADMISSION_MAX_IN_FLIGHT,
+    max_megapixels=settings.ADMISSION_MAX_MEGAPIXELS,
+    per_client_limit=settings.ADMISSION_PER_CLIENT_LIMIT
+)
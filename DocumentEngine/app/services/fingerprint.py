@@ -0,0 +1,47 @@
+import cv2
+import numpy as np
+
+class PerceptualHash:
+    """
+    Compact perceptual fingerprints of page images.
+    Robust to JPEG noise, small shifts and rescaling, so visually identical pages hash close together.
+    """
+    HASH_SIZE = 8       # 8x8 low-frequency DCT coefficients -> 64-bit hash
+    DCT_SIZE = 32       # Thumbnail edge length the DCT is computed on
+    FINE_THUMB_SIZE = 128   # Larger thumbnail for the fine hash, keeps the position of text lines and fields
+    FINE_SIZE = 32          # 32x32 low-frequency DCT coefficients -> 1024-bit hash
+    FINE_BYTES = FINE_SIZE * FINE_SIZE // 8
+
+    @staticmethod
+    def thumbnail(image: np.ndarray, size: int = DCT_SIZE) -> np.ndarray:
+        """Downscaled gray thumbnail used as the basis for fingerprints."""
+        gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # INTER_AREA averages pixels, which suppresses scanner noise before hashing
+        return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA)
+
+    @staticmethod
+    def phash(image: np.ndarray) -> int:
+        """DCT-based perceptual hash as a 64-bit integer."""
+        thumb = PerceptualHash.thumbnail(image).astype(np.float32)
+        dct = cv2.dct(thumb)
+        low = dct[:PerceptualHash.HASH_SIZE, :PerceptualHash.HASH_SIZE].flatten()
+        # Skip the DC term when computing the median, it only encodes overall brightness
+        bits = low > np.median(low[1:])
+        return int("".join("1" if b else "0" for b in bits), 2)
+
+    @staticmethod
+    def fine_hash(image: np.ndarray) -> bytes:
+        """
+        1024-bit DCT hash of a 128x128 thumbnail, packed into bytes.
+        Same construction as `phash` but with 16x more coefficients, so it separates pages that share
+        a form layout but differ in their filled-in values. Used to confirm coarse hash candidates.
+        """
+        thumb = PerceptualHash.thumbnail(image, PerceptualHash.FINE_THUMB_SIZE).astype(np.float32)
+        dct = cv2.dct(thumb)
+        low = dct[:PerceptualHash.FINE_SIZE, :PerceptualHash.FINE_SIZE].flatten()
+        bits = low > np.median(low[1:])
+        return np.packbits(bits).tobytes()
+
+    @staticmethod
+    def hamming(a: int, b: int) -> int:
+        return bin(a ^ b).count("1")
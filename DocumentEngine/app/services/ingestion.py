@@ -22,6 +22,21 @@ class IngestionService:
             color_space="BGR" if len(image.shape) == 3 else "GRAY"
         )
 
+    @staticmethod
+    def peek_megapixels(file: UploadFile) -> float:
+        """
+        Reads only the image header to estimate the work a request carries before admitting it.
+        Returns 0 if the header cannot be parsed; process_upload reports the actual error later.
+        """
+        try:
+            with Image.open(file.file) as pil_img:
+                w, h = pil_img.size
+            return (w * h) / 1_000_000
+        except Exception:
+            return 0.0
+        finally:
+            file.file.seek(0)
+
     @staticmethod
     async def process_upload(file: UploadFile) -> Tuple[np.ndarray, ImageMetadata]:
         """
@@ -11,11 +11,14 @@ pytesseract.pytesseract.tesseract_cmd = settings.TESSERACT_CMD
 
 class OCRService:
     @staticmethod
-    def run_ocr(image: np.ndarray, lang: str = "eng") -> TextContent:
+    def run_ocr(image: np.ndarray, lang: str = "eng", psm: int = 3, timeout_s: float = 0) -> TextContent:
         """
         Executes Tesseract with 'image_to_data' to get granular info (words, boxes, conf).
         Parses the raw dict result into structured Pydantic models.
+        `psm` selects Tesseract's page segmentation mode (3 = fully automatic, for whole pages).
+        `timeout_s` > 0 kills the Tesseract process if it runs longer and raises TimeoutError.
         """
+        try:
             # Check if binary exists
             import os
             if not os.path.exists(settings.TESSERACT_CMD):
@@ -25,12 +28,20 @@ class OCRService:
                 raise FileNotFoundError(error_msg)
 
             # PSM 3 is default (Fully automatic page segmentation, but no OSD)
-            custom_config = r'--oem 3 --psm 3'
+            custom_config = f'--oem 3 --psm {psm}'
             
             logger.debug(f"Starting OCR with lang={lang}, config={custom_config}")
             
             # image_to_data returns a dict with lists: 'text', 'left', 'top', 'width', 'height', 'conf', 'level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num'
-            data = pytesseract.image_to_data(image, lang=lang, config=custom_config, output_type=Output.DICT)
+            try:
+                data = pytesseract.image_to_data(
+                    image, lang=lang, config=custom_config, output_type=Output.DICT, timeout=timeout_s
+                )
+            except RuntimeError as e:
+                # pytesseract kills the subprocess and raises RuntimeError('Tesseract process timeout')
+                if "timeout" in str(e).lower():
+                    raise TimeoutError(f"Tesseract killed after {timeout_s:.2f}s") from e
+                raise
             
             words: List[Word] = []
             lines_map: Dict[Tuple[int, int, int], List[Word]] = {} # (block, par, line) -> [Words]
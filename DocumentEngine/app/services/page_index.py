@@ -0,0 +1,329 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterator, Optional
+import cv2
+import numpy as np
+from app.core.config import settings
+from app.core.logging import logger
+from app.models.schema import DocumentResponse
+from app.services.fingerprint import PerceptualHash
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, lock a byte of the lock file instead
+    fcntl = None
+    import msvcrt
+
+# Number of set bits for every 8-bit and 16-bit value, used for vectorized Hamming distance.
+# The 16-bit table halves the number of gathers on the coarse scan, which dominates lookup time.
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+_POPCOUNT16 = np.array([bin(i).count("1") for i in range(1 << 16)], dtype=np.uint8)
+
+# Index files and their record size in bytes, in the order a page is appended to them
+_RECORD_FILES = (("ids.bin", 16), ("fine.bin", PerceptualHash.FINE_BYTES), ("coarse.u64", 8))
+
+@dataclass
+class PageFingerprint:
+    coarse: int     # 64-bit perceptual hash, scanned for every lookup
+    fine: bytes     # 1024-bit perceptual hash, only compared for coarse candidates
+    detail: Optional[np.ndarray] = None     # Binarized page (ink = 255), compared pixel by pixel before reuse
+
+    # Longest side of the detail image, ~100 DPI for a letter page: enough to tell field values apart
+    DETAIL_MAX_DIM = 1024
+
+    @staticmethod
+    def from_image(image) -> "PageFingerprint":
+        return PageFingerprint(
+            coarse=PerceptualHash.phash(image),
+            fine=PerceptualHash.fine_hash(image),
+            detail=PageFingerprint.detail_image(image)
+        )
+
+    @staticmethod
+    def detail_image(image) -> np.ndarray:
+        gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        h, w = gray.shape[:2]
+        scale = min(1.0, PageFingerprint.DETAIL_MAX_DIM / max(h, w))
+        if scale < 1.0:
+            gray = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+        _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        return ink
+
+@dataclass
+class PageMatch:
+    document_id: str
+    similarity: float
+    lookup_ms: float
+
+class PageIndex:
+    """
+    On-disk index of perceptual page fingerprints, used to reuse results for re-scanned pages.
+
+    Storage is three append-only files with fixed-size records, so row i of each belongs to the same page:
+      coarse.u64  8 bytes/page   kept in memory and scanned with a vectorized XOR + popcount
+      fine.bin    128 bytes/page memory-mapped, only read for the few coarse candidates
+      ids.bin     16 bytes/page  document_id of the stored result in results/<document_id>.json
+    A million pages cost ~8 MB of RAM and a few tens of milliseconds per lookup.
+
+    Hashes cannot tell a re-scan from the same form with one field changed: both score ~0.9 on the fine
+    hash. So a hit is only reused after the page's detail image (results/<document_id>.png) is aligned to
+    the query and no tile has ink that the other page lacks.
+
+    Appends hold an exclusive lock on `index.lock`, so several worker processes can share one directory.
+    Before appending, a writer truncates any partial row left by a crashed writer and reads the rows other
+    processes appended, so its in-memory row numbers always match the files. Lookups pick up rows
+    from other processes when coarse.u64 has grown.
+    """
+    COARSE_MAX_DISTANCE = 10    # Out of 64 bits; wide on purpose, the fine fingerprint makes the decision
+    MAX_CANDIDATES = 32
+    LATENCY_WINDOW = 1000
+    # Detail check: ink within DETAIL_TOLERANCE_PX of ink on the other page is explained by the re-scan.
+    # A re-scan leaves at most a pixel or two unexplained per 32x32 tile, a changed field value 50+.
+    DETAIL_TOLERANCE_PX = 1
+    DETAIL_TILE = 32
+    DETAIL_MAX_TILE_DIFF = 16
+    DETAIL_ALIGN_DOWNSCALE = 4
+    DETAIL_EDGE_MARGIN_PX = 4   # Ink this close to the edge of either scan may have been cut off by it
+
+    def __init__(self, storage_dir: str, similarity_threshold: float = 0.8):
+        self.storage_dir = storage_dir
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()           # In-memory state and statistics
+        self._write_lock = threading.Lock()     # Serializes writers in this process, the file lock does across processes
+        self._coarse = np.zeros(1024, dtype=np.uint64)
+        self._size = 0
+
+        # Runtime statistics
+        self._lookups = 0
+        self._hits = 0
+        self._verified = 0
+        self._false_matches = 0
+        self._detail_rejections = 0
+        self._latencies: Deque[float] = deque(maxlen=PageIndex.LATENCY_WINDOW)
+
+        os.makedirs(os.path.join(storage_dir, "results"), exist_ok=True)
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.storage_dir, name)
+
+    def _file_rows(self, name: str, record_size: int) -> int:
+        path = self._path(name)
+        return os.path.getsize(path) // record_size if os.path.exists(path) else 0
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """Exclusive lock on the index files, across threads and processes."""
+        with self._write_lock, open(self._path("index.lock"), "a+b") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _sync_from_disk(self):
+        """
+        Makes the files consistent and the in-memory coarse hashes equal to them. Requires the file lock.
+        Rows are appended ids -> fine -> coarse, so a writer that crashed mid-append leaves partial rows
+        at the end of some files; they are truncated so row i of every file belongs to the same page again.
+        """
+        rows = min(self._file_rows(name, record_size) for name, record_size in _RECORD_FILES)
+        for name, record_size in _RECORD_FILES:
+            path = self._path(name)
+            if os.path.exists(path) and os.path.getsize(path) > rows * record_size:
+                logger.warning(f"Truncating incomplete rows in {path} to {rows} pages.")
+                with open(path, "r+b") as f:
+                    f.truncate(rows * record_size)
+
+        if rows == self._size:
+            return
+        with self._lock:
+            start = self._size if rows > self._size else 0     # Fewer rows than in memory: files were replaced
+            with open(self._path("coarse.u64"), "rb") as f:
+                f.seek(start * 8)
+                coarse = np.frombuffer(f.read((rows - start) * 8), dtype=np.uint64)
+            if rows > len(self._coarse):
+                grown = np.zeros(max(1024, rows * 2), dtype=np.uint64)
+                grown[:start] = self._coarse[:start]
+                self._coarse = grown
+            self._coarse[start:rows] = coarse
+            self._size = rows
+
+    def _load(self):
+        with self._file_lock():
+            self._sync_from_disk()
+        if self._size:
+            logger.info(f"Loaded page index with {self._size} fingerprints from {self.storage_dir}")
+
+    def lookup(self, fingerprint: PageFingerprint) -> Optional[PageMatch]:
+        """Returns the most similar stored page above the similarity threshold, if any."""
+        start_time = time.time()
+        if self._file_rows("coarse.u64", 8) != self._size:
+            # Another process appended pages (or left a partial row behind)
+            with self._file_lock():
+                self._sync_from_disk()
+        with self._lock:
+            size = self._size
+            coarse = self._coarse[:size]
+
+        match, rejections = None, 0
+        if len(coarse):
+            # 1. Hamming distance to every stored coarse hash at once
+            xor = np.bitwise_xor(coarse, np.uint64(fingerprint.coarse)).view(np.uint16).reshape(-1, 4)
+            counts = _POPCOUNT16[xor]
+            distances = counts[:, 0] + counts[:, 1] + counts[:, 2] + counts[:, 3]
+            candidates = np.flatnonzero(distances <= PageIndex.COARSE_MAX_DISTANCE)
+            if len(candidates) > PageIndex.MAX_CANDIDATES:
+                candidates = candidates[np.argsort(distances[candidates], kind="stable")[:PageIndex.MAX_CANDIDATES]]
+
+            # 2. Confirm candidates on the fine fingerprint, then on the detail image, closest first
+            if len(candidates):
+                fine = np.memmap(self._path("fine.bin"), dtype=np.uint8, mode="r", shape=(size, PerceptualHash.FINE_BYTES))
+                query = np.frombuffer(fingerprint.fine, dtype=np.uint8)
+                fine_distances = _POPCOUNT[np.bitwise_xor(fine[candidates], query)].sum(axis=1, dtype=np.uint32)
+                for best in np.argsort(fine_distances, kind="stable"):
+                    similarity = 1.0 - float(fine_distances[best]) / (PerceptualHash.FINE_BYTES * 8)
+                    if similarity < self.similarity_threshold:
+                        break
+                    document_id = self._read_id(int(candidates[best]))
+                    if fingerprint.detail is not None and not self._details_match(document_id, fingerprint.detail):
+                        rejections += 1
+                        continue
+                    match = PageMatch(document_id=document_id, similarity=round(similarity, 4), lookup_ms=0.0)
+                    break
+
+        lookup_ms = (time.time() - start_time) * 1000
+        with self._lock:
+            self._lookups += 1
+            self._latencies.append(lookup_ms)
+            if match:
+                self._hits += 1
+            self._detail_rejections += rejections
+        if match:
+            match.lookup_ms = round(lookup_ms, 3)
+            logger.info(f"Near-duplicate of {match.document_id} (similarity {match.similarity}) found in {lookup_ms:.2f}ms")
+        return match
+
+    def add(self, fingerprint: PageFingerprint, response: DocumentResponse):
+        """Stores a processed page so that later re-scans of it can reuse the result."""
+        with open(self._path(os.path.join("results", response.document_id + ".json")), "w", encoding="utf-8") as f:
+            f.write(response.model_dump_json())
+        if fingerprint.detail is not None:
+            cv2.imwrite(self._path(os.path.join("results", response.document_id + ".png")), fingerprint.detail)
+
+        with self._file_lock():
+            # Other processes may have appended since, the new page must land on the same row in every file
+            self._sync_from_disk()
+            with open(self._path("ids.bin"), "ab") as f:
+                f.write(bytes.fromhex(response.document_id))
+            with open(self._path("fine.bin"), "ab") as f:
+                f.write(fingerprint.fine)
+            with open(self._path("coarse.u64"), "ab") as f:
+                f.write(np.array([fingerprint.coarse], dtype=np.uint64).tobytes())
+
+            with self._lock:
+                if self._size == len(self._coarse):
+                    grown = np.zeros(len(self._coarse) * 2, dtype=np.uint64)
+                    grown[:self._size] = self._coarse[:self._size]
+                    self._coarse = grown
+                self._coarse[self._size] = fingerprint.coarse
+                self._size += 1
+
+    def load_result(self, document_id: str) -> Optional[DocumentResponse]:
+        path = self._path(os.path.join("results", document_id + ".json"))
+        try:
+            with open(path, encoding="utf-8") as f:
+                return DocumentResponse.model_validate_json(f.read())
+        except Exception as e:
+            logger.error(f"Failed to load stored result {document_id}: {str(e)}")
+            return None
+
+    def record_verification(self, is_false_match: bool):
+        """Records the outcome of re-processing a sampled hit, to estimate the false-match rate."""
+        with self._lock:
+            self._verified += 1
+            if is_false_match:
+                self._false_matches += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            latencies = np.array(self._latencies) if self._latencies else np.zeros(1)
+            return {
+                "indexed_pages": self._size,
+                "lookups": self._lookups,
+                "hits": self._hits,
+                "hit_rate": round(self._hits / self._lookups, 4) if self._lookups else 0.0,
+                "verified_hits": self._verified,
+                "false_matches": self._false_matches,
+                "false_match_rate": round(self._false_matches / self._verified, 4) if self._verified else 0.0,
+                "detail_rejections": self._detail_rejections,
+                "lookup_ms_p50": round(float(np.percentile(latencies, 50)), 3),
+                "lookup_ms_p95": round(float(np.percentile(latencies, 95)), 3),
+                "similarity_threshold": self.similarity_threshold
+            }
+
+    def _details_match(self, document_id: str, query: np.ndarray) -> bool:
+        """
+        Aligns the query's detail image to the stored one and compares their ink tile by tile.
+        Pages without a stored detail image never match, reusing them could hand out another page's values.
+        """
+        stored = cv2.imread(self._path(os.path.join("results", document_id + ".png")), cv2.IMREAD_GRAYSCALE)
+        if stored is None:
+            return False
+        h, w = stored.shape
+        if query.shape != stored.shape:
+            query = cv2.resize(query, (w, h), interpolation=cv2.INTER_NEAREST)
+
+        # Rotation + shift of the re-scan, estimated on blurred, downscaled copies and applied at full size
+        f = PageIndex.DETAIL_ALIGN_DOWNSCALE
+        small_stored = cv2.resize(stored, (w // f, h // f), interpolation=cv2.INTER_AREA).astype(np.float32)
+        small_query = cv2.resize(query, (w // f, h // f), interpolation=cv2.INTER_AREA).astype(np.float32)
+        warp = np.eye(2, 3, dtype=np.float32)
+        try:
+            _, warp = cv2.findTransformECC(
+                small_stored, small_query, warp, cv2.MOTION_EUCLIDEAN,
+                (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 50, 1e-4), None, 5
+            )
+        except cv2.error:
+            # No convergence: the pages are too different to align
+            return False
+        warp[:, 2] *= f
+        aligned = cv2.warpAffine(query, warp, (w, h), flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+
+        # Only compare where both scans saw the page: a shifted re-scan loses a strip at one edge
+        margin = np.ones((2 * PageIndex.DETAIL_EDGE_MARGIN_PX + 1,) * 2, dtype=np.uint8)
+        frame = cv2.warpAffine(np.full_like(query, 255), warp, (w, h), flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP)
+        frame = cv2.erode(frame, margin, borderType=cv2.BORDER_CONSTANT, borderValue=0)
+
+        # Ink on either page that is not within the tolerance of ink on the other one
+        kernel = np.ones((2 * PageIndex.DETAIL_TOLERANCE_PX + 1,) * 2, dtype=np.uint8)
+        extra = cv2.bitwise_and(aligned, cv2.bitwise_not(cv2.dilate(stored, kernel)))
+        missing = cv2.bitwise_and(stored, cv2.bitwise_not(cv2.dilate(aligned, kernel)))
+        diff = cv2.bitwise_and(cv2.bitwise_or(extra, missing), frame) > 0
+
+        tile = PageIndex.DETAIL_TILE
+        diff = np.pad(diff, ((0, -h % tile), (0, -w % tile)))
+        per_tile = diff.reshape(diff.shape[0] // tile, tile, diff.shape[1] // tile, tile).sum(axis=(1, 3))
+        return int(per_tile.max(initial=0)) <= PageIndex.DETAIL_MAX_TILE_DIFF
+
+    def _read_id(self, row: int) -> str:
+        with open(self._path("ids.bin"), "rb") as f:
+            f.seek(row * 16)
+            return f.read(16).hex()
+
+page_index: Optional[PageIndex] = (
+    PageIndex(settings.PAGE_INDEX_DIR, settings.DEDUP_SIMILARITY_THRESHOLD) if settings.PAGE_INDEX_DIR else None
+)
@@ -1,69 +1,221 @@
+import asyncio
+import random
 import time
 import uuid
 import numpy as np
 from fastapi import UploadFile
-from app.models.schema import DocumentResponse, ProcessingMetadata, LayoutBlock
+from typing import Any, Dict, Iterable, Optional
+from app.models.schema import DocumentResponse, DocumentType, ImageMetadata, ProcessingMetadata, LayoutBlock, TextContent, ExtractedEntities
+from app.core.config import settings
 from app.core.logging import logger
 from app.services.ingestion import IngestionService
 from app.services.preprocessing import PreprocessingService
 from app.services.ocr_service import OCRService
 from app.services.layout_engine import LayoutEngine
 from app.services.postprocessing import PostProcessingService
+from app.services.stage_graph import Stage, StageGraph, StageFailedError
+from app.services.template_registry import template_registry, TemplateRegistry
+from app.services.page_index import page_index, PageFingerprint, PageMatch
+from app.services.profiler import StageProfiler
+
+def _text_source(ctx: Dict[str, Any]) -> Optional[TextContent]:
+    """Text produced by whichever OCR path ran: template fields or full page."""
+    if "template_fields" in ctx:
+        return ctx["template_fields"][1]
+    return ctx.get("ocr")
+
+def _ocr_timeout(ctx: Dict[str, Any]) -> float:
+    """Tesseract time limit: the OCR budget, capped by what is left of the request deadline."""
+    timeout_s = settings.OCR_TIMEOUT_S
+    deadline = ctx.get("deadline")
+    if deadline is not None:
+        timeout_s = min(timeout_s, deadline - time.time())
+        if timeout_s <= 0:
+            raise TimeoutError("Request deadline exceeded before OCR started")
+    return timeout_s
 
 class DocumentPipeline:
+    # Declarative stage graph. Each stage receives the seeds ("image", "deadline") and its dependencies' outputs.
+    #
+    #   image -> template_match -> template_fields (template matched)
+    #                          \-> deskew -> enhance -> ocr -> classify_blocks, normalize_text (no match)
+    #                                   \-> detect_tables
+    #   extract_entities runs on whichever of template_fields / ocr produced text.
+    #
+    # When a registered form template matches, the full-page stages are bypassed and only its fields are OCR'd.
+    GRAPH = StageGraph([
+        Stage("template_match", lambda ctx: template_registry.match(ctx["image"]),
+              timeout_s=settings.STAGE_TIMEOUT_S),
+        Stage("template_fields", lambda ctx: TemplateRegistry.extract_fields(
+                  ctx["image"], ctx["template_match"], timeout_s=_ocr_timeout(ctx)),
+              # Optional so a failed or timed-out match bypasses it and falls back to the full-page path
+              optional_depends_on=("template_match",), condition=lambda ctx: ctx.get("template_match") is not None,
+              timeout_s=settings.OCR_TIMEOUT_S, required=True),
+        # Full-page fallback, runs only when no template matched (or matching was disabled / failed)
+        Stage("deskew", lambda ctx: PreprocessingService.correct_skew(ctx["image"]),
+              optional_depends_on=("template_match",), condition=lambda ctx: ctx.get("template_match") is None,
+              timeout_s=settings.STAGE_TIMEOUT_S),
+        Stage("enhance", lambda ctx: PreprocessingService.enhance_image(ctx["deskew"]),
+              depends_on=("deskew",), timeout_s=settings.STAGE_TIMEOUT_S),
+        Stage("ocr", lambda ctx: OCRService.run_ocr(ctx["enhance"], timeout_s=_ocr_timeout(ctx)),
+              depends_on=("enhance",), timeout_s=settings.OCR_TIMEOUT_S, required=True),
+        # Table detection only needs the deskewed (non-binarized) image, so it runs alongside OCR
+        Stage("detect_tables", lambda ctx: LayoutEngine.detect_tables(ctx["deskew"]),
+              depends_on=("deskew",), timeout_s=settings.STAGE_TIMEOUT_S),
+        # Group lines into blocks if needed. Using simplified line-based block approach for now.
+        Stage("classify_blocks", lambda ctx: LayoutEngine.classify_blocks(ctx["ocr"].lines),
+              depends_on=("ocr",), timeout_s=settings.STAGE_TIMEOUT_S),
+        Stage("extract_entities", lambda ctx: PostProcessingService.extract_entities(_text_source(ctx).full_text),
+              optional_depends_on=("ocr", "template_fields"), condition=lambda ctx: _text_source(ctx) is not None,
+              timeout_s=settings.STAGE_TIMEOUT_S),
+        # Template-matched pages keep their "key: value" lines, so normalization only applies to full-page OCR
+        Stage("normalize_text", lambda ctx: PostProcessingService.normalize_text(ctx["ocr"].full_text),
+              depends_on=("ocr",), timeout_s=settings.STAGE_TIMEOUT_S),
+    ])
+
     @staticmethod
-    async def process_document(file: UploadFile) -> DocumentResponse:
+    async def process_document(
+        file: UploadFile,
+        enable_stages: Optional[Iterable[str]] = None,
+        disable_stages: Optional[Iterable[str]] = None,
+        dedup: bool = True,
+        profile: bool = False,
+        deadline: Optional[float] = None
+    ) -> DocumentResponse:
+        """
+        Runs a document through the stage graph.
+        `deadline` is an absolute time.time() after which remaining work is abandoned and OCR is killed.
+        """
         start_time = time.time()
-        
-        # 1. Ingestion
+        StageProfiler.request_started()
+        profiler: Optional[StageProfiler] = None
         try:
+            # Validate the stage selection before doing any work
+            enabled = DocumentPipeline.GRAPH.resolve_enabled(enable_stages, disable_stages)
+
+            # 1. Ingestion. Decoding is the first expensive step, so a request that already missed its deadline stops here.
+            DocumentPipeline._check_deadline(deadline, "ingestion")
             image, metadata = await IngestionService.process_upload(file)
-        except Exception as e:
-            raise e
-
-        # 2. Preprocessing
-        # Deskew
-        image_deskewed = PreprocessingService.correct_skew(image)
-        # Enhance for OCR
-        image_for_ocr = PreprocessingService.enhance_image(image_deskewed)
-
-        # 3. OCR Core
-        # Pass the preprocessed image to Tesseract
-        text_content = OCRService.run_ocr(image_for_ocr)
-
-        # 4. Layout Analysis
-        # Use deskewed (but not binary/thresholded) image for table detection usually, 
-        # but here we use the original image's shape mostly.
-        tables = LayoutEngine.detect_tables(image_deskewed)
-        
-        # Classify Blocks from OCR lines
-        # Group lines into blocks if needed. Using simplified line-based block approach for now.
-        layout_blocks = LayoutEngine.classify_blocks(text_content.lines)
+            DocumentPipeline._check_deadline(deadline, "ingestion")
+
+            profiler = StageProfiler.start(requested=profile)
+
+            # Near-duplicate lookup. Only full default-stage results are stored, so only those can be reused.
+            # Profiled requests always run the stages, since the point is to see what they cost.
+            fingerprint, page_match, verify_match = None, None, False
+            if page_index is not None and dedup and profiler is None and not enable_stages and not disable_stages:
+                fingerprint = await asyncio.to_thread(PageFingerprint.from_image, image)
+                page_match = await asyncio.to_thread(page_index.lookup, fingerprint)
+                if page_match is not None:
+                    # A small sample of hits is processed anyway to keep measuring the false-match rate
+                    verify_match = random.random() < settings.DEDUP_VERIFY_SAMPLE_RATE
+                    stored = None if verify_match else await asyncio.to_thread(page_index.load_result, page_match.document_id)
+                    if stored is not None:
+                        return DocumentPipeline._reuse_result(stored, metadata, page_match, start_time)
+
+            # 2-5. Preprocessing, OCR, Layout Analysis and Post Processing as a stage graph.
+            # Run off the event loop; the graph itself fans independent stages out to worker threads.
+            seeds = {"image": image, "deadline": deadline}
+            if profiler is None:
+                graph_result = await asyncio.to_thread(DocumentPipeline.GRAPH.run, seeds, enabled, deadline=deadline)
+            else:
+                # Serial stages keep this request's memory measurements from overlapping each other
+                graph_result = await asyncio.to_thread(
+                    DocumentPipeline.GRAPH.run, seeds, enabled,
+                    stage_wrapper=profiler.wrap, max_parallel=1, deadline=deadline
+                )
+            outputs: Dict[str, Any] = graph_result.outputs
+
+            text_content: TextContent = _text_source(outputs) or TextContent(full_text="")
+            if "normalize_text" in outputs:
+                text_content.full_text = outputs["normalize_text"]
+
+            template_match = outputs.get("template_match")
+            if "template_fields" in outputs:
+                layout_blocks = outputs["template_fields"][0]
+                document_type = template_match.template.document_type
+            else:
+                layout_blocks = outputs.get("classify_blocks", [])
+                document_type = DocumentType.UNKNOWN # Could add ML classifier here
 
-        # 5. Post Processing
-        entities = PostProcessingService.extract_entities(text_content.full_text)
-        normalized_text = PostProcessingService.normalize_text(text_content.full_text)
-        text_content.full_text = normalized_text
+            # 6. Serialization Construction
+            process_time_ms = (time.time() - start_time) * 1000
 
-        # 6. Serialization Construction
+            proc_metadata = ProcessingMetadata(
+                runtime_ms=round(process_time_ms, 2),
+                ocr_engine="tesseract",
+                model_type="lstm",
+                degraded=graph_result.degraded,
+                stages=graph_result.reports,
+                template_id=template_match.template.template_id if template_match else None
+            )
+
+            document_id = uuid.uuid4().hex
+            if profiler is not None:
+                proc_metadata.profile_id = profiler.finish(graph_result.reports, document_id, proc_metadata.runtime_ms)
+
+            response = DocumentResponse(
+                document_id=document_id,
+                document_type=document_type,
+                image_metadata=metadata,
+                layout={"blocks": layout_blocks},
+                text_content=text_content,
+                tables=outputs.get("detect_tables", []),
+                entities=outputs.get("extract_entities") or ExtractedEntities(),
+                processing_metadata=proc_metadata
+            )
+
+            if page_match is not None and verify_match:
+                stored = await asyncio.to_thread(page_index.load_result, page_match.document_id)
+                if stored is not None:
+                    is_false_match = await asyncio.to_thread(DocumentPipeline._results_differ, stored, response)
+                    page_index.record_verification(is_false_match=is_false_match)
+            elif fingerprint is not None and page_match is None and not graph_result.degraded:
+                await asyncio.to_thread(page_index.add, fingerprint, response)
+
+            if graph_result.degraded:
+                logger.warning(f"Pipeline finished degraded in {process_time_ms:.2f}ms: "
+                               f"{[r.name for r in graph_result.reports if r.error]}")
+            else:
+                logger.info(f"Pipeline finished in {process_time_ms:.2f}ms")
+            return response
+        finally:
+            if profiler is not None:
+                # No-op after a normal finish; otherwise saves what was measured and frees the profiling slot
+                profiler.finish()
+            StageProfiler.request_finished()
+
+    @staticmethod
+    def _check_deadline(deadline: Optional[float], stage: str):
+        if deadline is not None and time.time() >= deadline:
+            raise StageFailedError(stage, "timeout: Request deadline exceeded", timed_out=True)
+
+    @staticmethod
+    def _results_differ(stored: DocumentResponse, fresh: DocumentResponse) -> bool:
+        """
+        Whether reusing `stored` would have returned different values than processing the page did.
+        Any changed word or field value counts: a single wrong amount is exactly the error reuse must not make.
+        """
+        if stored.text_content.full_text.split() != fresh.text_content.full_text.split():
+            return True
+        stored_fields = [(b.content.key, b.content.value) for b in stored.layout.get("blocks", []) if b.content.key]
+        fresh_fields = [(b.content.key, b.content.value) for b in fresh.layout.get("blocks", []) if b.content.key]
+        return stored_fields != fresh_fields
+
+    @staticmethod
+    def _reuse_result(stored: DocumentResponse, metadata: ImageMetadata, page_match: PageMatch, start_time: float) -> DocumentResponse:
+        """Builds the response for a re-scanned page from the stored result of its earlier scan."""
         process_time_ms = (time.time() - start_time) * 1000
-        
-        proc_metadata = ProcessingMetadata(
-            runtime_ms=round(process_time_ms, 2),
-            ocr_engine="tesseract",
-            model_type="lstm"
-        )
-        
-        response = DocumentResponse(
-            document_id=uuid.uuid4().hex,
-            document_type="unknown", # Could add ML classifier here
-            image_metadata=metadata,
-            layout={"blocks": layout_blocks},
-            text_content=text_content,
-            tables=tables,
-            entities=entities,
-            processing_metadata=proc_metadata
-        )
-        
-        logger.info(f"Pipeline finished in {process_time_ms:.2f}ms")
-        return response
+        proc_metadata = stored.processing_metadata.model_copy(update={
+            "runtime_ms": round(process_time_ms, 2),
+            "stages": [],
+            "reused_from": page_match.document_id,
+            "dedup_similarity": page_match.similarity,
+            "dedup_lookup_ms": page_match.lookup_ms
+        })
+        logger.info(f"Pipeline reused result of {page_match.document_id} in {process_time_ms:.2f}ms")
+        return stored.model_copy(update={
+            "document_id": uuid.uuid4().hex,
+            "image_metadata": metadata,
+            "processing_metadata": proc_metadata
+        })
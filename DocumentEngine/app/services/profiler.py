@@ -0,0 +1,239 @@
+import cProfile
+import json
+import os
+import pstats
+import random
+import re
+import shutil
+import threading
+import time
+import tracemalloc
+import uuid
+from typing import Any, Dict, List, Optional
+from app.core.config import settings
+from app.core.logging import logger
+from app.models.schema import StageReport
+from app.services.stage_graph import StageFunc
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+_PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+def _current_rss() -> Optional[int]:
+    """Resident set size of this process in bytes, or None where it cannot be read."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class StageProfiler:
+    """
+    Captures a cProfile CPU profile, tracemalloc peak and RSS delta for every stage of one pipeline run.
+
+    Profiling is opt-in per request. Only one request is profiled at a time and its stages run serially.
+    The CPU profile and CPU time cover the stage's own thread, but tracemalloc and RSS cover the whole
+    process: allocations of requests running at the same time are counted too, and tracemalloc slows
+    those requests down while the profile is captured. Each stage therefore records how many requests
+    were in flight; its memory figures belong to the stage alone only when that number is 1.
+    Tesseract runs as a subprocess, so its memory shows up in neither figure.
+    """
+    _active = threading.Lock()
+    _requests_lock = threading.Lock()
+    _requests_in_flight = 0
+
+    def __init__(self):
+        self.profile_id = uuid.uuid4().hex
+        self.directory = os.path.join(settings.PROFILE_DIR, self.profile_id)
+        self.started_at = time.time()
+        self._stages: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._finished = False
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def request_started():
+        """Counts a request in progress, profiled or not, so profiles can tell whether memory was shared."""
+        with StageProfiler._requests_lock:
+            StageProfiler._requests_in_flight += 1
+
+    @staticmethod
+    def request_finished():
+        with StageProfiler._requests_lock:
+            StageProfiler._requests_in_flight -= 1
+
+    @staticmethod
+    def start(requested: bool = False) -> Optional["StageProfiler"]:
+        """
+        Returns a profiler if this request should be profiled, else None.
+        The unprofiled path costs one comparison (plus a random draw when sampling is configured).
+        """
+        if not requested:
+            if settings.PROFILE_SAMPLE_RATE <= 0 or random.random() >= settings.PROFILE_SAMPLE_RATE:
+                return None
+        if not StageProfiler._active.acquire(blocking=False):
+            logger.info("Another request is being profiled, skipping profiling for this one.")
+            return None
+        try:
+            tracemalloc.start()
+            return StageProfiler()
+        except Exception:
+            tracemalloc.stop()
+            StageProfiler._active.release()
+            raise
+
+    def wrap(self, name: str, func: StageFunc) -> StageFunc:
+        """Stage wrapper for StageGraph.run; profiles the stage on the worker thread that executes it."""
+        def profiled(ctx: Dict[str, Any]) -> Any:
+            profile = cProfile.Profile()
+            requests_before = StageProfiler._requests_in_flight
+            rss_before = _current_rss()
+            tracemalloc.reset_peak()
+            traced_before, _ = tracemalloc.get_traced_memory()
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ allows one active profiler per process; an abandoned (timed-out) stage may hold it
+                logger.warning(f"Could not profile stage '{name}', another profiler is active.")
+                return func(ctx)
+            try:
+                return func(ctx)
+            finally:
+                profile.disable()
+                wall_ms = (time.perf_counter() - wall_start) * 1000
+                cpu_ms = (time.thread_time() - cpu_start) * 1000
+                _, traced_peak = tracemalloc.get_traced_memory()
+                rss_after = _current_rss()
+                self._record(name, profile, {
+                    "wall_ms": round(wall_ms, 2),
+                    "cpu_ms": round(cpu_ms, 2),
+                    # Process-wide, see requests_in_flight
+                    "peak_traced_bytes": max(0, traced_peak - traced_before),
+                    "rss_delta_bytes": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+                    "requests_in_flight": max(requests_before, StageProfiler._requests_in_flight)
+                })
+        return profiled
+
+    def _record(self, name: str, profile: cProfile.Profile, measurements: Dict[str, Any]):
+        profile_file = f"{name}.prof"
+        profile.dump_stats(os.path.join(self.directory, profile_file))
+
+        # Top functions by cumulative time, so the summary is useful without downloading the .prof file
+        stats = pstats.Stats(profile)
+        top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:settings.PROFILE_TOP_FUNCTIONS]
+        measurements["profile_file"] = profile_file
+        measurements["top_functions"] = [
+            {
+                "function": f"{func} ({os.path.basename(filename)}:{line})",
+                "calls": nc,
+                "total_ms": round(tt * 1000, 3),
+                "cumulative_ms": round(ct * 1000, 3)
+            }
+            for (filename, line, func), (cc, nc, tt, ct, callers) in top
+        ]
+        with self._lock:
+            self._stages[name] = measurements
+
+    def finish(self, reports: Optional[List[StageReport]] = None, document_id: Optional[str] = None,
+               runtime_ms: Optional[float] = None) -> str:
+        """
+        Writes the summary next to the per-stage .prof files and releases the profiling slot.
+        Safe to call more than once; only the first call writes. Without reports (the request failed),
+        the summary lists the stages that were measured.
+        """
+        with self._lock:
+            if self._finished:
+                return self.profile_id
+            self._finished = True
+        try:
+            with self._lock:
+                if reports is not None:
+                    stages = [
+                        {**report.model_dump(mode="json"), **self._stages.get(report.name, {})}
+                        for report in reports
+                    ]
+                else:
+                    stages = [{"name": name, **measurements} for name, measurements in self._stages.items()]
+            summary = {
+                "profile_id": self.profile_id,
+                "created_at": self.started_at,
+                "document_id": document_id,
+                "runtime_ms": runtime_ms,
+                "completed": reports is not None,
+                "memory_scope": "process",
+                "max_requests_in_flight": max((s.get("requests_in_flight", 1) for s in stages), default=1),
+                "stages": stages
+            }
+            with open(os.path.join(self.directory, "summary.json"), "w", encoding="utf-8") as f:
+                json.dump(summary, f, indent=2)
+            logger.info(f"Profile {self.profile_id} written to {self.directory}")
+        finally:
+            tracemalloc.stop()
+            StageProfiler._active.release()
+        StageProfiler._prune(keep=self.profile_id)
+        return self.profile_id
+
+    @staticmethod
+    def _prune(keep: str):
+        """Deletes the oldest profiles beyond PROFILE_MAX_STORED."""
+        if settings.PROFILE_MAX_STORED <= 0:
+            return
+        try:
+            entries = [
+                entry for entry in os.scandir(settings.PROFILE_DIR)
+                if entry.is_dir() and _PROFILE_ID_PATTERN.match(entry.name) and entry.name != keep
+            ]
+            excess = len(entries) + 1 - settings.PROFILE_MAX_STORED
+            if excess <= 0:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:excess]:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError as e:
+            logger.warning(f"Could not prune old profiles: {str(e)}")
+
+    # --- Stored artifacts ---
+
+    @staticmethod
+    def list_profiles(limit: int = 50) -> List[Dict[str, Any]]:
+        if not os.path.isdir(settings.PROFILE_DIR):
+            return []
+        summaries = []
+        for profile_id in os.listdir(settings.PROFILE_DIR):
+            summary = StageProfiler.load_summary(profile_id)
+            if summary is not None:
+                summaries.append({
+                    "profile_id": profile_id,
+                    "created_at": summary["created_at"],
+                    "document_id": summary["document_id"],
+                    "runtime_ms": summary["runtime_ms"]
+                })
+        summaries.sort(key=lambda s: s["created_at"], reverse=True)
+        return summaries[:limit]
+
+    @staticmethod
+    def load_summary(profile_id: str) -> Optional[Dict[str, Any]]:
+        if not _PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        path = os.path.join(settings.PROFILE_DIR, profile_id, "summary.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    @staticmethod
+    def stage_profile_path(profile_id: str, stage: str) -> Optional[str]:
+        """Path of a stage's .prof file (loadable with pstats or snakeviz), validated against the summary."""
+        summary = StageProfiler.load_summary(profile_id)
+        if summary is None:
+            return None
+        for entry in summary["stages"]:
+            if entry["name"] == stage and entry.get("profile_file"):
+                return os.path.join(settings.PROFILE_DIR, profile_id, entry["profile_file"])
+        return None
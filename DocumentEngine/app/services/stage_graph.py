@@ -0,0 +1,287 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from app.core.config import settings
+from app.core.logging import logger
+from app.models.schema import StageReport, StageStatus
+
+# Stage callables receive the seed inputs plus the outputs of their dependencies, keyed by name.
+StageFunc = Callable[[Dict[str, Any]], Any]
+StageCondition = Callable[[Dict[str, Any]], bool]
+StageWrapper = Callable[[str, StageFunc], StageFunc]
+
+
+class StageFailedError(RuntimeError):
+    """Raised when a stage marked as required fails, times out, or is skipped because a dependency did."""
+
+    def __init__(self, stage: str, reason: str, timed_out: bool = False):
+        super().__init__(f"Required stage '{stage}' {reason}")
+        self.stage = stage
+        self.reason = reason
+        self.timed_out = timed_out
+
+
+class UnknownStageError(ValueError):
+    """Raised when a request enables or disables a stage that is not in the graph."""
+
+
+_FAILURE_STATUSES = (StageStatus.FAILED, StageStatus.TIMEOUT, StageStatus.SKIPPED)
+
+
+@dataclass
+class Stage:
+    name: str
+    func: StageFunc
+    depends_on: Tuple[str, ...] = ()
+    # Waited on, and passed in when they succeed, but their failure or absence does not block this stage
+    optional_depends_on: Tuple[str, ...] = ()
+    # Evaluated on the stage inputs before running; False bypasses the stage (and its dependents)
+    condition: Optional[StageCondition] = None
+    timeout_s: Optional[float] = None
+    required: bool = False
+    enabled_by_default: bool = True
+
+
+@dataclass
+class StageGraphResult:
+    outputs: Dict[str, Any] = field(default_factory=dict)
+    reports: List[StageReport] = field(default_factory=list)
+
+    @property
+    def degraded(self) -> bool:
+        return any(r.status in _FAILURE_STATUSES for r in self.reports)
+
+
+class StageGraph:
+    """
+    Declarative dependency graph of named pipeline stages.
+    Stages whose dependencies are satisfied run concurrently on a shared thread pool
+    (OpenCV and Tesseract release the GIL, so this gives real parallelism).
+    A failed or timed-out stage only skips its dependents. A required stage that fails, times out or is
+    skipped raises StageFailedError, so the request fails instead of returning empty output.
+    Disabled and bypassed (condition not met) stages propagate that status to their dependents.
+    """
+
+    # How often to re-check stages that are still queued behind other requests' work
+    QUEUE_POLL_S = 0.05
+
+    _executor: Optional[ThreadPoolExecutor] = None
+    _executor_lock = threading.Lock()
+
+    def __init__(self, stages: Iterable[Stage]):
+        self.stages: Dict[str, Stage] = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Duplicate stage name: {stage.name}")
+            self.stages[stage.name] = stage
+
+        for stage in self.stages.values():
+            for dep in stage.depends_on + stage.optional_depends_on:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage '{stage.name}' depends on unknown stage '{dep}'")
+        self.order = self._topological_order()
+
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        # Shared across requests so timed-out (abandoned) stages still count against the worker budget
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=settings.PIPELINE_MAX_WORKERS,
+                    thread_name_prefix="stage"
+                )
+            return cls._executor
+
+    def _topological_order(self) -> List[str]:
+        order: List[str] = []
+        state: Dict[str, int] = {}  # 1 = visiting, 2 = done
+
+        def visit(name: str):
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                raise ValueError(f"Cycle detected in stage graph at '{name}'")
+            state[name] = 1
+            stage = self.stages[name]
+            for dep in stage.depends_on + stage.optional_depends_on:
+                visit(dep)
+            state[name] = 2
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def resolve_enabled(self, enable: Optional[Iterable[str]] = None, disable: Optional[Iterable[str]] = None) -> Set[str]:
+        """
+        Computes the set of stages to run for a request.
+        Explicitly enabled stages pull in their dependencies; explicitly disabled stages win over defaults.
+        Raises UnknownStageError for names that are not in the graph.
+        """
+        enable = set(enable or [])
+        disable = set(disable or [])
+        unknown = (enable | disable) - set(self.stages)
+        if unknown:
+            raise UnknownStageError(f"Unknown stage(s): {', '.join(sorted(unknown))}")
+
+        active = {name for name, stage in self.stages.items() if stage.enabled_by_default}
+        active |= enable
+        active -= disable
+
+        # Pull in dependencies of explicitly enabled stages, unless the caller disabled them
+        pending = list(enable)
+        while pending:
+            for dep in self.stages[pending.pop()].depends_on:
+                if dep not in active and dep not in disable:
+                    active.add(dep)
+                    pending.append(dep)
+        return active
+
+    def run(
+        self,
+        seeds: Dict[str, Any],
+        enabled: Optional[Set[str]] = None,
+        stage_wrapper: Optional[StageWrapper] = None,
+        max_parallel: Optional[int] = None,
+        deadline: Optional[float] = None
+    ) -> StageGraphResult:
+        """
+        Executes the graph. `seeds` are inputs available to every stage (e.g. the ingested image).
+        Blocks until every runnable stage has finished, failed, or timed out.
+        `stage_wrapper` decorates each stage callable (e.g. for profiling); `max_parallel` caps how many
+        stages of this run execute at once (1 runs them serially in dependency order).
+        `deadline` is an absolute time.time() for the whole request: it caps every stage timeout,
+        and stages that have not started by then time out without running.
+        A stage's own timeout counts from when it starts executing, not from when it is queued
+        on the shared pool behind other requests' stages.
+        """
+        enabled = set(self.stages) if enabled is None else enabled
+        executor = self._get_executor()
+        result = StageGraphResult()
+        reports: Dict[str, StageReport] = {}
+        running: Dict[Future, Tuple[str, float]] = {}  # future -> (stage, submit time)
+        started: Dict[str, float] = {}  # stage -> time a worker thread picked it up
+        timed_out: Set[str] = set()     # Stages that timed out, or were skipped because a dependency did
+        pending = [name for name in self.order]
+
+        def finish(name: str, status: StageStatus, runtime_ms: float = 0.0, error: Optional[str] = None,
+                   caused_by_timeout: bool = False):
+            reports[name] = StageReport(name=name, status=status, runtime_ms=round(runtime_ms, 2), error=error)
+            if status == StageStatus.TIMEOUT or caused_by_timeout:
+                timed_out.add(name)
+            if self.stages[name].required and status in _FAILURE_STATUSES:
+                raise StageFailedError(name, f"{status.value}: {error}", timed_out=name in timed_out)
+
+        def expires_at(name: str) -> Optional[float]:
+            # A started stage times out at its own limit or the request deadline, whichever comes first
+            timeout_s = self.stages[name].timeout_s
+            limits = [started[name] + timeout_s] if timeout_s else []
+            if deadline is not None:
+                limits.append(deadline)
+            return min(limits) if limits else None
+
+        def timed(name: str, func: StageFunc) -> StageFunc:
+            def run_stage(inputs: Dict[str, Any]) -> Any:
+                started[name] = time.time()
+                return func(inputs)
+            return run_stage
+
+        def schedule():
+            for name in list(pending):
+                stage = self.stages[name]
+                if name not in enabled:
+                    pending.remove(name)
+                    finish(name, StageStatus.DISABLED)
+                    continue
+                if any(dep not in reports for dep in stage.depends_on + stage.optional_depends_on):
+                    continue  # Still waiting on a dependency
+                if max_parallel and len(running) >= max_parallel:
+                    continue
+                pending.remove(name)
+                dep_status = {dep: reports[dep].status for dep in stage.depends_on}
+                failed = [dep for dep, status in dep_status.items() if status in _FAILURE_STATUSES]
+                if failed:
+                    if deadline is not None and time.time() >= deadline:
+                        # The request ran out of time; report it as such rather than as a missing input
+                        finish(name, StageStatus.TIMEOUT, error="Request deadline exceeded")
+                    else:
+                        finish(name, StageStatus.SKIPPED, error=f"Dependency not available: {', '.join(failed)}",
+                               caused_by_timeout=any(dep in timed_out for dep in failed))
+                    continue
+                if StageStatus.DISABLED in dep_status.values():
+                    finish(name, StageStatus.DISABLED)
+                    continue
+                if StageStatus.BYPASSED in dep_status.values():
+                    finish(name, StageStatus.BYPASSED)
+                    continue
+                inputs = dict(seeds)
+                inputs.update({
+                    dep: result.outputs[dep] for dep in stage.depends_on + stage.optional_depends_on
+                    if dep in result.outputs
+                })
+                if stage.condition is not None and not stage.condition(inputs):
+                    finish(name, StageStatus.BYPASSED)
+                    continue
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    finish(name, StageStatus.TIMEOUT, error="Request deadline exceeded")
+                    continue
+                func = stage_wrapper(name, stage.func) if stage_wrapper else stage.func
+                running[executor.submit(timed(name, func), inputs)] = (name, now)
+
+        try:
+            schedule()
+            while running:
+                now = time.time()
+                wake_times = []
+                for name, _ in running.values():
+                    if name in started:
+                        expiry = expires_at(name)
+                        if expiry is not None:
+                            wake_times.append(expiry - now)
+                    else:
+                        # Queued: wake up to start its clock once it runs, or to drop it at the request deadline
+                        wake_times.append(StageGraph.QUEUE_POLL_S if deadline is None else min(StageGraph.QUEUE_POLL_S, deadline - now))
+                wait_for = max(0.0, min(wake_times)) if wake_times else None
+                done, _ = wait(list(running), timeout=wait_for, return_when=FIRST_COMPLETED)
+
+                for fut in done:
+                    name, submitted = running.pop(fut)
+                    runtime_ms = (time.time() - started.get(name, submitted)) * 1000
+                    try:
+                        result.outputs[name] = fut.result()
+                        finish(name, StageStatus.OK, runtime_ms)
+                    except TimeoutError as e:
+                        # The stage enforced its own time limit (e.g. a killed Tesseract process)
+                        logger.warning(f"Stage '{name}' timed out: {str(e)}")
+                        finish(name, StageStatus.TIMEOUT, runtime_ms, error=str(e))
+                    except Exception as e:
+                        logger.error(f"Stage '{name}' failed: {str(e)}")
+                        finish(name, StageStatus.FAILED, runtime_ms, error=str(e))
+
+                now = time.time()
+                for fut, (name, _) in list(running.items()):
+                    if name not in started:
+                        if deadline is not None and now >= deadline and fut.cancel():
+                            running.pop(fut)
+                            logger.warning(f"Stage '{name}' was still queued at the request deadline, dropping it.")
+                            finish(name, StageStatus.TIMEOUT, error="Request deadline exceeded while queued")
+                        continue
+                    expiry = expires_at(name)
+                    if expiry is not None and now >= expiry:
+                        # Threads cannot be killed; the stage is abandoned and its result discarded
+                        running.pop(fut)
+                        fut.cancel()
+                        elapsed_s = now - started[name]
+                        logger.warning(f"Stage '{name}' timed out after {elapsed_s:.2f}s, abandoning it.")
+                        finish(name, StageStatus.TIMEOUT, elapsed_s * 1000, error=f"Timed out after {elapsed_s:.2f}s")
+
+                schedule()
+        finally:
+            for fut in running:
+                fut.cancel()
+
+        result.reports = [reports[name] for name in self.order if name in reports]
+        return result
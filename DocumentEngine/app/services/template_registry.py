@@ -0,0 +1,371 @@
+import os
+import threading
+import time
+import uuid
+import cv2
+import numpy as np
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from app.core.config import settings
+from app.core.logging import logger
+from app.models.schema import (
+    FormTemplateInfo, TemplateField, DocumentType, LayoutBlock, BlockType, BlockContent, TextContent
+)
+from app.services.fingerprint import PerceptualHash
+from app.services.ocr_service import OCRService
+
+@dataclass
+class _TemplateEntry:
+    info: FormTemplateInfo
+    layout_hash: np.ndarray         # Unpacked fine-hash bits of the page cropped to its ink
+    keypoints: np.ndarray           # (N, 2) float32, in downscaled matching coordinates
+    descriptors: Optional[np.ndarray]
+    scale: float                    # Matching coordinates = full-resolution coordinates * scale
+
+@dataclass
+class TemplateMatch:
+    template: FormTemplateInfo
+    homography: np.ndarray          # Maps page pixels -> template reference pixels
+    inliers: int
+    runtime_ms: float
+
+class TemplateRegistry:
+    """
+    Registry of known form layouts (reference image + named field regions).
+    Incoming pages are ranked against the registered templates by layout hash, verified with
+    ORB feature matching and a RANSAC homography, and then only the named fields are OCR'd.
+    With a storage directory, registries in several worker processes stay in sync through it.
+    """
+    RATIO_TEST = 0.75
+    RANSAC_REPROJ_THRESHOLD = 5.0
+    # A page printed from the template puts 40-60% of its ratio-test matches on the homography, an
+    # unrelated page or a different form with similar boxes 5-25%. Capping RANSAC at 500 iterations still
+    # converges for inlier ratios above ~0.3 and keeps a non-matching candidate at ~10ms instead of ~40ms.
+    RANSAC_MAX_ITERS = 500
+    RANSAC_CONFIDENCE = 0.995
+    MIN_INLIER_RATIO = 0.3
+    STRIP_PADDING = 20
+    # Share of ink ignored on each side when cropping to the content, so scanner specks and page edges
+    # do not move the crop
+    INK_TRIM = 0.005
+
+    def __init__(self, storage_dir: str = ""):
+        self.storage_dir = storage_dir
+        self._templates: Dict[str, _TemplateEntry] = {}
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._disk_state: Dict[str, int] = {}     # Template file name -> mtime_ns as last loaded
+        if storage_dir:
+            self._sync_from_disk()
+
+    # --- Registration ---
+
+    def register(self, name: str, image: np.ndarray, fields: List[TemplateField],
+                 document_type: DocumentType = DocumentType.FORM) -> FormTemplateInfo:
+        """Registers a reference image and its field regions. Raises ValueError on invalid fields."""
+        gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        h, w = gray.shape[:2]
+
+        if not fields:
+            raise ValueError("A template needs at least one field.")
+        names = [f.name for f in fields]
+        if len(set(names)) != len(names):
+            raise ValueError("Template field names must be unique.")
+        for f in fields:
+            x1, y1, x2, y2 = f.bbox
+            if not (0 <= x1 < x2 <= w and 0 <= y1 < y2 <= h):
+                raise ValueError(f"Field '{f.name}' bbox {f.bbox} is outside the {w}x{h} reference image.")
+
+        info = FormTemplateInfo(
+            template_id=f"tpl_{uuid.uuid4().hex[:8]}",
+            name=name,
+            document_type=document_type,
+            width=w,
+            height=h,
+            fields=fields
+        )
+        entry = self._build_entry(info, gray)
+        if entry.descriptors is None or len(entry.keypoints) < settings.TEMPLATE_MIN_INLIERS:
+            raise ValueError("Reference image has too little structure to be matched reliably.")
+
+        with self._sync_lock:
+            if self.storage_dir:
+                self._save_to_disk(info, gray)
+            with self._lock:
+                self._templates[info.template_id] = entry
+
+        logger.info(f"Registered template {info.template_id} '{name}' with {len(fields)} fields, "
+                    f"{len(entry.keypoints)} keypoints.")
+        return info
+
+    def list_templates(self) -> List[FormTemplateInfo]:
+        self._sync_from_disk()
+        with self._lock:
+            return [entry.info for entry in self._templates.values()]
+
+    def remove(self, template_id: str) -> bool:
+        self._sync_from_disk()
+        with self._sync_lock:
+            with self._lock:
+                removed = self._templates.pop(template_id, None)
+            if removed and self.storage_dir:
+                # The .json goes first: other workers only load templates whose .json exists
+                for ext in (".json", ".png"):
+                    path = os.path.join(self.storage_dir, template_id + ext)
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._disk_state.pop(template_id + ".json", None)
+        return removed is not None
+
+    # --- Matching ---
+
+    def match(self, image: np.ndarray) -> Optional[TemplateMatch]:
+        """
+        Finds the registered template the page was printed from, or None for full-page fallback.
+        Never raises: a matching failure simply means the page is processed generically.
+        """
+        start_time = time.time()
+        try:
+            self._sync_from_disk()
+            with self._lock:
+                entries = list(self._templates.values())
+            if not entries:
+                return None
+
+            gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+            # Downscale once; the hash and the features are both computed on the small page
+            small, scale = TemplateRegistry._downscale(gray)
+
+            # 1. Rank candidates cheaply by layout hash, only the closest few get feature verification
+            page_hash = TemplateRegistry._layout_hash(small)
+            entries.sort(key=lambda e: int(np.count_nonzero(e.layout_hash != page_hash)))
+
+            # 2. ORB features on the downscaled page
+            points, descriptors = TemplateRegistry._compute_features(small)
+            if descriptors is None or len(points) < settings.TEMPLATE_MIN_INLIERS:
+                return None
+
+            matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+            best: Optional[TemplateMatch] = None
+            for entry in entries[:settings.TEMPLATE_MAX_CANDIDATES]:
+                if entry.descriptors is None:
+                    continue
+
+                # Lowe's ratio test to keep distinctive matches only
+                good = []
+                for pair in matcher.knnMatch(descriptors, entry.descriptors, k=2):
+                    if len(pair) == 2 and pair[0].distance < TemplateRegistry.RATIO_TEST * pair[1].distance:
+                        good.append(pair[0])
+                if len(good) < settings.TEMPLATE_MIN_INLIERS:
+                    continue
+
+                src = points[[m.queryIdx for m in good]]
+                dst = entry.keypoints[[m.trainIdx for m in good]]
+                H, mask = cv2.findHomography(
+                    src, dst, cv2.RANSAC, TemplateRegistry.RANSAC_REPROJ_THRESHOLD,
+                    maxIters=TemplateRegistry.RANSAC_MAX_ITERS, confidence=TemplateRegistry.RANSAC_CONFIDENCE
+                )
+                if H is None:
+                    continue
+                inliers = int(mask.sum())
+                if inliers < settings.TEMPLATE_MIN_INLIERS or inliers < TemplateRegistry.MIN_INLIER_RATIO * len(good):
+                    continue
+                if not TemplateRegistry._is_plausible(H):
+                    continue
+
+                if best is None or inliers > best.inliers:
+                    # Lift the homography from matching coordinates to full resolution on both sides
+                    H_full = np.diag([1.0 / entry.scale, 1.0 / entry.scale, 1.0]) @ H @ np.diag([scale, scale, 1.0])
+                    best = TemplateMatch(template=entry.info, homography=H_full, inliers=inliers, runtime_ms=0.0)
+
+            runtime_ms = (time.time() - start_time) * 1000
+            if best is not None:
+                best.runtime_ms = round(runtime_ms, 2)
+                logger.info(f"Matched template {best.template.template_id} ({best.inliers} inliers) in {runtime_ms:.2f}ms")
+            else:
+                logger.debug(f"No template matched in {runtime_ms:.2f}ms")
+            return best
+
+        except Exception as e:
+            logger.error(f"Template matching failed: {str(e)}")
+            return None
+
+    @staticmethod
+    def extract_fields(image: np.ndarray, match: TemplateMatch, lang: str = "eng",
+                       timeout_s: float = 0) -> Tuple[List[LayoutBlock], TextContent]:
+        """
+        Aligns the page to the template and OCRs only the named field regions.
+        Returns one KEY_VALUE block per field (bbox in page coordinates) and the combined text.
+        """
+        info = match.template
+        gray = image if len(image.shape) == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        aligned = cv2.warpPerspective(
+            gray, match.homography, (info.width, info.height),
+            flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE
+        )
+
+        # Stack all ROIs into one strip so Tesseract is launched once per page rather than once per field.
+        # Each field gets its own horizontal band; words are assigned back to fields by vertical position.
+        pad = TemplateRegistry.STRIP_PADDING
+        crops = [aligned[f.bbox[1]:f.bbox[3], f.bbox[0]:f.bbox[2]] for f in info.fields]
+        strip_w = max(c.shape[1] for c in crops) + 2 * pad
+        strip_h = sum(c.shape[0] + pad for c in crops) + pad
+        strip = np.full((strip_h, strip_w), 255, dtype=np.uint8)
+        band_starts: List[int] = []
+        y = pad
+        for crop in crops:
+            h, w = crop.shape[:2]
+            strip[y:y + h, pad:pad + w] = crop
+            band_starts.append(y)
+            y += h + pad
+
+        # PSM 4: single column of text of variable sizes, which is what the strip is
+        text = OCRService.run_ocr(strip, lang=lang, psm=4, timeout_s=timeout_s)
+
+        field_words: List[List] = [[] for _ in info.fields]
+        for line in text.lines:
+            for word in line.words:
+                center_y = (word.bbox[1] + word.bbox[3]) / 2
+                idx = bisect_right(band_starts, center_y) - 1
+                if idx >= 0:
+                    field_words[idx].append(word)
+
+        H_inv = np.linalg.inv(match.homography)
+        page_h, page_w = gray.shape[:2]
+        blocks: List[LayoutBlock] = []
+        text_lines: List[str] = []
+        for field, words in zip(info.fields, field_words):
+            value = " ".join(w.text for w in words)
+            confidence = sum(w.confidence for w in words) / len(words) if words else 0.0
+
+            # Report the region where the field actually is on the submitted page
+            x1, y1, x2, y2 = field.bbox
+            corners = np.float32([[x1, y1], [x2, y1], [x2, y2], [x1, y2]]).reshape(-1, 1, 2)
+            page_corners = cv2.perspectiveTransform(corners, H_inv).reshape(-1, 2)
+            bx1, by1 = np.clip(page_corners.min(axis=0), 0, [page_w, page_h]).astype(int)
+            bx2, by2 = np.clip(page_corners.max(axis=0), 0, [page_w, page_h]).astype(int)
+
+            blocks.append(LayoutBlock(
+                type=BlockType.KEY_VALUE,
+                id=f"kv_{uuid.uuid4().hex[:8]}",
+                bbox=[int(bx1), int(by1), int(bx2), int(by2)],
+                confidence=confidence,
+                content=BlockContent(key=field.name, value=value)
+            ))
+            text_lines.append(f"{field.name}: {value}")
+
+        return blocks, TextContent(full_text="\n".join(text_lines))
+
+    # --- Internals ---
+
+    @staticmethod
+    def _downscale(gray: np.ndarray) -> Tuple[np.ndarray, float]:
+        h, w = gray.shape[:2]
+        scale = min(1.0, settings.TEMPLATE_MATCH_MAX_DIM / max(h, w))
+        small = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else gray
+        return small, scale
+
+    @staticmethod
+    def _layout_hash(small: np.ndarray) -> np.ndarray:
+        """
+        Fine hash of the page cropped to the bounding box of its ink.
+        Cropping removes the shift and scale a re-scan adds, which move a whole-page hash of the same form
+        as far as an unrelated form. The 1024-bit hash then still tells forms with similar boxes apart.
+        """
+        ink = small < 128
+        total = int(ink.sum())
+        if total:
+            bounds = []
+            for profile in (ink.sum(axis=1), ink.sum(axis=0)):
+                cumulative = np.cumsum(profile)
+                lo = int(np.searchsorted(cumulative, total * TemplateRegistry.INK_TRIM))
+                hi = int(np.searchsorted(cumulative, total * (1 - TemplateRegistry.INK_TRIM)))
+                bounds.append((lo, max(hi, lo) + 1))
+            (y1, y2), (x1, x2) = bounds
+            small = small[y1:y2, x1:x2]
+        return np.unpackbits(np.frombuffer(PerceptualHash.fine_hash(small), dtype=np.uint8))
+
+    @staticmethod
+    def _compute_features(small: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        # ORB objects are not thread-safe, so each call creates its own
+        orb = cv2.ORB_create(nfeatures=settings.TEMPLATE_ORB_FEATURES)
+        keypoints, descriptors = orb.detectAndCompute(small, None)
+        points = np.float32([kp.pt for kp in keypoints]).reshape(-1, 2)
+        return points, descriptors
+
+    @staticmethod
+    def _is_plausible(H: np.ndarray) -> bool:
+        # Both sides are normalized to the same matching size, so a real match is close to area-preserving.
+        # Degenerate RANSAC solutions (collapsed or mirrored pages) show up as extreme or negative determinants.
+        det = np.linalg.det(H[:2, :2])
+        return 0.25 < det < 4.0
+
+    @staticmethod
+    def _build_entry(info: FormTemplateInfo, gray: np.ndarray) -> _TemplateEntry:
+        small, scale = TemplateRegistry._downscale(gray)
+        points, descriptors = TemplateRegistry._compute_features(small)
+        return _TemplateEntry(
+            info=info,
+            layout_hash=TemplateRegistry._layout_hash(small),
+            keypoints=points,
+            descriptors=descriptors,
+            scale=scale
+        )
+
+    def _save_to_disk(self, info: FormTemplateInfo, gray: np.ndarray):
+        os.makedirs(self.storage_dir, exist_ok=True)
+        cv2.imwrite(os.path.join(self.storage_dir, info.template_id + ".png"), gray)
+        json_path = os.path.join(self.storage_dir, info.template_id + ".json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            f.write(info.model_dump_json(indent=2))
+        # Already in memory, so the next sync must not load it again
+        self._disk_state[info.template_id + ".json"] = os.stat(json_path).st_mtime_ns
+
+    def _sync_from_disk(self):
+        """
+        Brings the in-memory templates in line with the storage directory: loads templates that another
+        worker process registered and drops the ones it removed. A directory listing per call, so cheap
+        enough to run before every match.
+        """
+        if not self.storage_dir or not os.path.isdir(self.storage_dir):
+            return
+        with self._sync_lock:
+            try:
+                state = {
+                    e.name: e.stat().st_mtime_ns for e in os.scandir(self.storage_dir)
+                    if e.name.endswith(".json")
+                }
+            except OSError as e:
+                logger.error(f"Failed to list template directory {self.storage_dir}: {str(e)}")
+                return
+            if state == self._disk_state:
+                return
+
+            loaded: Dict[str, _TemplateEntry] = {}
+            for filename in sorted(state):
+                if self._disk_state.get(filename) == state[filename]:
+                    continue
+                try:
+                    with open(os.path.join(self.storage_dir, filename), encoding="utf-8") as f:
+                        info = FormTemplateInfo.model_validate_json(f.read())
+                    gray = cv2.imread(os.path.join(self.storage_dir, info.template_id + ".png"), cv2.IMREAD_GRAYSCALE)
+                    if gray is None:
+                        logger.warning(f"Reference image missing for template {info.template_id}, skipping.")
+                        continue
+                    loaded[info.template_id] = self._build_entry(info, gray)
+                except Exception as e:
+                    logger.error(f"Failed to load template {filename}: {str(e)}")
+
+            known = {filename[:-len(".json")] for filename in state}
+            with self._lock:
+                for template_id in [t for t in self._templates if t not in known]:
+                    del self._templates[template_id]
+                self._templates.update(loaded)
+                count = len(self._templates)
+            self._disk_state = state
+        if loaded:
+            logger.info(f"Loaded {len(loaded)} form templates from {self.storage_dir}, {count} registered")
+
+template_registry = TemplateRegistry(settings.TEMPLATE_DIR)
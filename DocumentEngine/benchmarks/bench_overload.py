@@ -0,0 +1,132 @@
+"""
+Open-loop load generator for the /process endpoint, to measure goodput under overload.
+
+Requests arrive at a fixed rate regardless of how fast the server answers (like real clients),
+each with a client-side timeout. Goodput is the rate of complete (non-degraded) 200 responses that
+arrived within that timeout; degraded 200s, where some stage failed or ran out of time, are counted apart.
+Run it against the server with ADMISSION_ENABLED=1 and =0 to compare load shedding with queueing.
+
+    uvicorn app.main:app --port 8000
+    python -m benchmarks.bench_overload --rate 20 --duration 30 --client-timeout 5
+"""
+import argparse
+import io
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from PIL import Image, ImageDraw
+
+def make_page(width: int, height: int) -> bytes:
+    """A synthetic text page with a ruled table, PNG-encoded."""
+    img = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(img)
+    for i, y in enumerate(range(60, height - 60, 40)):
+        draw.text((60, y), f"Line {i}: invoice total amount due {i * 37 % 1000}.00 USD", fill=0)
+    top = height // 2
+    for k in range(6):
+        draw.line((60, top + k * 50, width - 60, top + k * 50), fill=0, width=2)
+    for k in range(5):
+        x = 60 + k * (width - 120) // 4
+        draw.line((x, top, x, top + 250), fill=0, width=2)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+def multipart_body(payload: bytes, filename: str = "page.png") -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: image/png\r\n\r\n"
+    ).encode() + payload + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def send(url: str, body: bytes, content_type: str, client_timeout: float, deadline_header: bool, client_id: str) -> Dict:
+    headers = {"Content-Type": content_type, "X-Client-Id": client_id}
+    if deadline_header:
+        headers["X-Request-Deadline-Ms"] = str(int(client_timeout * 1000))
+    req = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    start = time.perf_counter()
+    degraded = False
+    try:
+        with urllib.request.urlopen(req, timeout=client_timeout) as resp:
+            body = resp.read()
+            status = resp.status
+        degraded = json.loads(body)["processing_metadata"].get("degraded", False)
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception:
+        # Socket timeout (the client gave up) or connection error
+        status = None
+    latency = time.perf_counter() - start
+    return {
+        "status": status,
+        "degraded": degraded,
+        "latency": latency,
+        "in_time": status == 200 and not degraded and latency <= client_timeout
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000/api/v1/process")
+    parser.add_argument("--params", default="", help="Extra query string, e.g. 'disable=ocr' without Tesseract")
+    parser.add_argument("--rate", type=float, default=20.0, help="Offered load in requests per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds of load")
+    parser.add_argument("--client-timeout", type=float, default=5.0)
+    parser.add_argument("--no-deadline-header", action="store_true", help="Do not propagate the client timeout")
+    parser.add_argument("--clients", type=int, default=4, help="Distinct X-Client-Id values, round robin")
+    parser.add_argument("--width", type=int, default=1700)
+    parser.add_argument("--height", type=int, default=2200)
+    args = parser.parse_args()
+
+    url = f"{args.url}?{args.params}" if args.params else args.url
+    body, content_type = multipart_body(make_page(args.width, args.height))
+    total = int(args.rate * args.duration)
+    results: List[Optional[Dict]] = [None] * total
+    lock = threading.Lock()
+
+    def worker(i: int):
+        result = send(url, body, content_type, args.client_timeout, not args.no_deadline_header, f"client-{i % args.clients}")
+        with lock:
+            results[i] = result
+
+    # Enough threads that the generator never becomes the bottleneck: every request in flight gets one
+    max_outstanding = int(args.rate * args.client_timeout) + 16
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_outstanding) as pool:
+        for i in range(total):
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(worker, i)
+    elapsed = time.perf_counter() - start
+
+    done = [r for r in results if r is not None]
+    ok = [r for r in done if r["in_time"]]
+    statuses: Dict[str, int] = {}
+    for r in done:
+        key = str(r["status"]) if r["status"] is not None else "client_timeout"
+        if r["degraded"]:
+            key += "_degraded"
+        statuses[key] = statuses.get(key, 0) + 1
+    ok_latency = np.array([r["latency"] for r in ok]) if ok else np.zeros(1)
+
+    print(json.dumps({
+        "offered_rps": args.rate,
+        "requests": total,
+        "wall_s": round(elapsed, 1),
+        "goodput_rps": round(len(ok) / args.duration, 2),
+        "success_in_time": len(ok),
+        "statuses": statuses,
+        "ok_latency_p50_s": round(float(np.percentile(ok_latency, 50)), 3),
+        "ok_latency_p99_s": round(float(np.percentile(ok_latency, 99)), 3)
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
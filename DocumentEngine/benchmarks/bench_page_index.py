@@ -0,0 +1,147 @@
+"""
+Benchmark for the near-duplicate page index.
+
+Builds an index of synthetic pages (padded with random fingerprints to the requested size),
+then looks up re-scans of indexed pages (shift, rotation, noise, JPEG re-encode) and pages that
+were never indexed: unrelated layouts, same-layout forms with different values, and indexed pages
+with a single field value changed.
+
+Reports duplicate recall, false-match rate and lookup latency.
+
+    python -m benchmarks.bench_page_index --index-size 1000000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import uuid
+from typing import Optional
+import cv2
+import numpy as np
+from app.models.schema import DocumentResponse, ImageMetadata, TextContent, ProcessingMetadata
+from app.services.fingerprint import PerceptualHash
+from app.services.page_index import PageIndex, PageFingerprint
+
+WORDS = "invoice total amount date customer account number address payment due tax item quantity price".split()
+
+def make_page(rng: random.Random, layout_seed: int, values_seed: int, edited_line: Optional[int] = None) -> np.ndarray:
+    """
+    A letter-size page: fixed labels/lines from layout_seed, filled-in values from values_seed.
+    With edited_line, that one line gets a different value and the rest of the page stays identical.
+    """
+    page = np.full((1100, 850), 255, dtype=np.uint8)
+    layout = random.Random(layout_seed)
+    values = random.Random(values_seed)
+    y, line = 80, 0
+    while y < 1020:
+        x = 60
+        label = " ".join(layout.choice(WORDS) for _ in range(layout.randint(1, 3)))
+        cv2.putText(page, label, (x, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 0, 1, cv2.LINE_AA)
+        value = " ".join(values.choice(WORDS) + str(values.randint(0, 999)) for _ in range(values.randint(1, 4)))
+        if line == edited_line:
+            edit = random.Random(values_seed + 1)
+            value = " ".join(edit.choice(WORDS) + str(edit.randint(0, 999)) for _ in range(edit.randint(1, 4)))
+        cv2.putText(page, value, (x + 320, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6, 0, 1, cv2.LINE_AA)
+        line += 1
+        if layout.random() < 0.2:
+            cv2.line(page, (40, y + 12), (810, y + 12), 0, 1)
+        y += layout.randint(28, 60)
+    return page
+
+def rescan(rng: random.Random, page: np.ndarray) -> np.ndarray:
+    """Simulates scanning the same sheet again: small shift/rotation, sensor noise, JPEG artifacts."""
+    h, w = page.shape
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), rng.uniform(-0.5, 0.5), 1.0)
+    M[:, 2] += (rng.uniform(-6, 6), rng.uniform(-6, 6))
+    out = cv2.warpAffine(page, M, (w, h), borderMode=cv2.BORDER_REPLICATE)
+    noise = np.random.default_rng(rng.randint(0, 2**31)).normal(0, 6, out.shape)
+    out = np.clip(out.astype(np.float32) + noise, 0, 255).astype(np.uint8)
+    _, buf = cv2.imencode(".jpg", out, [cv2.IMWRITE_JPEG_QUALITY, rng.randint(60, 90)])
+    return cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+
+def dummy_response(document_id: str, width: int, height: int) -> DocumentResponse:
+    return DocumentResponse(
+        document_id=document_id,
+        image_metadata=ImageMetadata(width=width, height=height, format="PNG", color_space="GRAY"),
+        text_content=TextContent(full_text=""),
+        processing_metadata=ProcessingMetadata(runtime_ms=0.0)
+    )
+
+def write_filler(storage_dir: str, count: int, seed: int):
+    """Pads the index with random fingerprints, written directly in the on-disk record format."""
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(storage_dir, "ids.bin"), "wb") as f:
+        f.write(rng.integers(0, 256, size=count * 16, dtype=np.uint8).tobytes())
+    with open(os.path.join(storage_dir, "fine.bin"), "wb") as f:
+        f.write(rng.integers(0, 256, size=count * PerceptualHash.FINE_BYTES, dtype=np.uint8).tobytes())
+    with open(os.path.join(storage_dir, "coarse.u64"), "wb") as f:
+        f.write(rng.integers(0, 2**63, size=count, dtype=np.uint64).tobytes())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--index-size", type=int, default=1_000_000, help="Total fingerprints in the index")
+    parser.add_argument("--pages", type=int, default=200, help="Real synthetic pages indexed")
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as storage_dir:
+        write_filler(storage_dir, max(0, args.index_size - args.pages), args.seed)
+        index = PageIndex(storage_dir, similarity_threshold=args.threshold)
+
+        originals = []
+        for i in range(args.pages):
+            # Every 4 pages share a layout, so same-form/different-values confusion is exercised
+            layout_seed, values_seed = i // 4, 10_000 + i
+            page = make_page(rng, layout_seed, values_seed)
+            document_id = uuid.uuid4().hex
+            index.add(PageFingerprint.from_image(page), dummy_response(document_id, page.shape[1], page.shape[0]))
+            originals.append((document_id, page, layout_seed, values_seed))
+
+        def timed_lookup(image):
+            fp = PageFingerprint.from_image(image)
+            start = time.perf_counter()
+            match = index.lookup(fp)
+            return match, (time.perf_counter() - start) * 1000
+
+        latencies = []
+        hits = wrong_hits = 0
+        for document_id, page, _, _ in originals:
+            match, ms = timed_lookup(rescan(rng, page))
+            latencies.append(ms)
+            if match and match.document_id == document_id:
+                hits += 1
+            elif match:
+                wrong_hits += 1
+
+        unseen_matches = same_form_matches = edited_matches = 0
+        for i, (_, _, layout_seed, values_seed) in enumerate(originals):
+            # Never-indexed page with an unrelated layout
+            match, ms = timed_lookup(rescan(rng, make_page(rng, 1_000_000 + i, 50_000 + i)))
+            latencies.append(ms)
+            unseen_matches += match is not None
+            # Never-indexed page on an indexed form layout, with different values filled in
+            match, ms = timed_lookup(rescan(rng, make_page(rng, layout_seed, 90_000 + i)))
+            latencies.append(ms)
+            same_form_matches += match is not None
+            # Indexed page with one field value changed, everything else identical
+            match, ms = timed_lookup(rescan(rng, make_page(rng, layout_seed, values_seed, edited_line=rng.randint(0, 15))))
+            latencies.append(ms)
+            edited_matches += match is not None
+
+        n = len(originals)
+        lat = np.array(latencies)
+        print(f"index size:                {index.stats()['indexed_pages']}")
+        print(f"similarity threshold:      {args.threshold}")
+        print(f"duplicate recall:          {hits / n:.3f} ({hits}/{n})")
+        print(f"duplicate -> wrong page:   {wrong_hits / n:.3f} ({wrong_hits}/{n})")
+        print(f"false match, unseen page:  {unseen_matches / n:.3f} ({unseen_matches}/{n})")
+        print(f"false match, same form:    {same_form_matches / n:.3f} ({same_form_matches}/{n})")
+        print(f"false match, one field:    {edited_matches / n:.3f} ({edited_matches}/{n})")
+        print(f"rejected by detail check:  {index.stats()['detail_rejections']}")
+        print(f"lookup latency ms:         p50={np.percentile(lat, 50):.2f} p95={np.percentile(lat, 95):.2f} max={lat.max():.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Benchmark for form-template matching and ROI-only OCR.
+
+Registers synthetic form templates, then processes filled-in, re-scanned copies of them (rotation, scale,
+shift, JPEG; the pages cycle through all registered templates) and pages that match no template. Reports:
+- template matching time on matched pages and the extra latency it adds to unmatched pages
+- pixels handed to Tesseract: the stacked field strip vs. the full page
+- OCR time on the template path (match + field OCR) vs. the full-page path (deskew + enhance + OCR),
+  when Tesseract is installed
+
+    python -m benchmarks.bench_template_ocr --pages 20 --templates 5
+    python -m benchmarks.bench_template_ocr --pages 30 --templates 30    # many templates registered
+"""
+import argparse
+import os
+import random
+import time
+import cv2
+import numpy as np
+from app.core.config import settings
+from app.models.schema import TemplateField
+from app.services.ocr_service import OCRService
+from app.services.preprocessing import PreprocessingService
+from app.services.template_registry import TemplateRegistry
+
+LABELS = [
+    "Invoice Number", "Customer Name", "Billing Address", "Date of Issue", "Payment Terms", "Account No",
+    "Tax ID", "Total Due", "Signature", "Bank Ref", "PO Number", "Ship To", "Currency", "Notes",
+    "Contact Phone", "Email", "Department", "Approved By", "Cost Center", "Reference"
+]
+WORDS = "invoice total amount date customer account number address payment due tax item quantity price".split()
+
+def make_form(layout_seed: int, width: int = 2550, height: int = 3300):
+    """A letter-size 300 DPI form: title, labelled boxes on the right. Returns the image and its fields."""
+    layout = random.Random(layout_seed)
+    labels = layout.sample(LABELS, len(LABELS))
+    page = np.full((height, width), 255, dtype=np.uint8)
+    cv2.putText(page, f"FORM {layout_seed} - {layout.choice(WORDS).upper()} REQUEST", (150, 160),
+                cv2.FONT_HERSHEY_DUPLEX, 2.6, 0, 4)
+    fields = []
+    box_x1 = layout.choice([1100, 1200, 1300])
+    for i, y in enumerate(range(330, height - 200, layout.choice([180, 210, 240]))):
+        cv2.putText(page, labels[i % len(labels)], (150, y), cv2.FONT_HERSHEY_SIMPLEX, 2.1, 0, 4)
+        box = [box_x1, y - 85, width - 150, y + 35]
+        cv2.rectangle(page, (box[0], box[1]), (box[2], box[3]), 0, 4)
+        fields.append(TemplateField(name=labels[i % len(labels)].lower().replace(" ", "_"), bbox=box))
+    return page, fields
+
+def fill_and_rescan(rng: random.Random, form: np.ndarray, fields) -> np.ndarray:
+    """Writes values into the boxes, then simulates a scan: rotation, scale, shift and JPEG artifacts."""
+    page = form.copy()
+    for field in fields:
+        value = " ".join(rng.choice(WORDS) + str(rng.randint(0, 999)) for _ in range(rng.randint(1, 3)))
+        cv2.putText(page, value, (field.bbox[0] + 30, field.bbox[3] - 30), cv2.FONT_HERSHEY_SIMPLEX, 2.0, 0, 4)
+    h, w = page.shape
+    M = cv2.getRotationMatrix2D((w / 2, h / 2), rng.uniform(-2, 2), rng.uniform(0.95, 1.05))
+    M[:, 2] += (rng.uniform(-60, 60), rng.uniform(-60, 60))
+    page = cv2.warpAffine(page, M, (w, h), borderValue=255)
+    _, buf = cv2.imencode(".jpg", page, [cv2.IMWRITE_JPEG_QUALITY, rng.randint(70, 90)])
+    return cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+
+def make_text_page(rng: random.Random, width: int = 2550, height: int = 3300) -> np.ndarray:
+    """A page of running text that matches no registered template."""
+    page = np.full((height, width), 255, dtype=np.uint8)
+    for y in range(200, height - 200, 80):
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 12)))
+        cv2.putText(page, line, (150, y), cv2.FONT_HERSHEY_SIMPLEX, 1.8, 0, 3)
+    return page
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+def percentiles(values) -> str:
+    arr = np.array(values) if values else np.zeros(1)
+    return f"p50={np.percentile(arr, 50):.1f} p95={np.percentile(arr, 95):.1f}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=20, help="Filled-in pages per path")
+    parser.add_argument("--templates", type=int, default=5, help="Registered templates")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    registry = TemplateRegistry()
+    forms = []
+    for k in range(args.templates):
+        form, fields = make_form(k)
+        info = registry.register(f"form-{k}", form, fields)
+        forms.append((form, fields, info.template_id))
+
+    run_ocr = os.path.exists(settings.TESSERACT_CMD)
+    matched_ms, unmatched_ms, strip_ratio = [], [], []
+    template_ocr_ms, full_ocr_ms = [], []
+    correct = 0
+    for i in range(args.pages):
+        form, fields, expected_id = forms[i % len(forms)]
+        page = fill_and_rescan(rng, form, fields)
+        match, ms = timed(registry.match, page)
+        matched_ms.append(ms)
+        if match is None or match.template.template_id != expected_id:
+            continue
+        correct += 1
+        strip_pixels = sum((f.bbox[2] - f.bbox[0]) * (f.bbox[3] - f.bbox[1]) for f in fields)
+        strip_ratio.append(strip_pixels / page.size)
+        if run_ocr:
+            _, field_ms = timed(TemplateRegistry.extract_fields, page, match)
+            template_ocr_ms.append(ms + field_ms)
+            deskewed, deskew_ms = timed(PreprocessingService.correct_skew, page)
+            enhanced, enhance_ms = timed(PreprocessingService.enhance_image, deskewed)
+            _, ocr_ms = timed(OCRService.run_ocr, enhanced)
+            full_ocr_ms.append(deskew_ms + enhance_ms + ocr_ms)
+
+    false_matches = 0
+    for _ in range(args.pages):
+        match, ms = timed(registry.match, make_text_page(rng))
+        unmatched_ms.append(ms)
+        false_matches += match is not None
+
+    n = args.pages
+    print(f"registered templates:           {args.templates}")
+    print(f"matched to the right template:  {correct}/{n}")
+    print(f"unmatched pages matched:        {false_matches}/{n}")
+    print(f"match ms, matched pages:        {percentiles(matched_ms)}")
+    print(f"match ms, unmatched pages:      {percentiles(unmatched_ms)} (added before the full-page path)")
+    print(f"field pixels / page pixels:     {np.mean(strip_ratio) if strip_ratio else 0:.3f}")
+    if run_ocr:
+        print(f"template path ms (match + OCR): {percentiles(template_ocr_ms)}")
+        print(f"full-page path ms:              {percentiles(full_ocr_ms)}")
+        if template_ocr_ms and full_ocr_ms:
+            print(f"speedup (p50):                  {np.median(full_ocr_ms) / np.median(template_ocr_ms):.1f}x")
+    else:
+        print(f"OCR timing skipped: Tesseract not found at {settings.TESSERACT_CMD}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+import os
+import stat
+import sys
+import time
+import numpy as np
+import pytest
+import pytesseract
+from app.core.config import settings
+from app.services.ocr_service import OCRService
+
+@pytest.fixture
+def stuck_tesseract(tmp_path, monkeypatch):
+    """A tesseract executable that reports a version, then hangs on any real work and records its pid."""
+    pid_file = tmp_path / "tesseract.pid"
+    script = tmp_path / "tesseract"
+    script.write_text(
+        "#!/bin/sh\n"
+        "if [ \"$1\" = \"--version\" ]; then echo 'tesseract 5.3.0'; exit 0; fi\n"
+        f"echo $$ > {pid_file}\n"
+        "exec sleep 600\n"
+    )
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setattr(settings, "TESSERACT_CMD", str(script))
+    monkeypatch.setattr(pytesseract.pytesseract, "tesseract_cmd", str(script))
+    return pid_file
+
+@pytest.mark.skipif(sys.platform.startswith("win"), reason="needs a POSIX shell script as tesseract")
+def test_stuck_tesseract_is_killed_at_timeout(stuck_tesseract):
+    image = np.full((100, 100), 255, dtype=np.uint8)
+    start = time.time()
+    with pytest.raises(TimeoutError):
+        OCRService.run_ocr(image, timeout_s=0.5)
+    assert time.time() - start < 3
+
+    pid = int(stuck_tesseract.read_text())
+    with pytest.raises(ProcessLookupError):
+        os.kill(pid, 0)
@@ -0,0 +1,126 @@
+import multiprocessing
+import os
+import random
+import uuid
+import numpy as np
+import pytest
+from app.models.schema import DocumentResponse, ImageMetadata, TextContent, ProcessingMetadata
+from app.services.fingerprint import PerceptualHash
+from app.services.page_index import PageIndex, PageFingerprint
+from benchmarks.bench_page_index import make_page, rescan
+
+def make_fingerprint(rng: np.random.Generator) -> PageFingerprint:
+    return PageFingerprint(
+        coarse=int(rng.integers(0, 2**63, dtype=np.uint64)),
+        fine=rng.integers(0, 256, size=PerceptualHash.FINE_BYTES, dtype=np.uint8).tobytes()
+    )
+
+def make_response(document_id: str) -> DocumentResponse:
+    return DocumentResponse(
+        document_id=document_id,
+        image_metadata=ImageMetadata(width=10, height=10, format="PNG", color_space="GRAY"),
+        text_content=TextContent(full_text=document_id),
+        processing_metadata=ProcessingMetadata(runtime_ms=0.0)
+    )
+
+def add_pages(index: PageIndex, rng: np.random.Generator, count: int):
+    pages = []
+    for _ in range(count):
+        fingerprint, document_id = make_fingerprint(rng), uuid.uuid4().hex
+        index.add(fingerprint, make_response(document_id))
+        pages.append((fingerprint, document_id))
+    return pages
+
+def assert_all_found(index: PageIndex, pages):
+    for fingerprint, document_id in pages:
+        match = index.lookup(fingerprint)
+        assert match is not None and match.document_id == document_id
+        assert match.similarity == 1.0
+
+def test_add_lookup_reload_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    index = PageIndex(str(tmp_path))
+    pages = add_pages(index, rng, 50)
+    assert_all_found(index, pages)
+    assert index.lookup(make_fingerprint(rng)) is None
+    assert index.load_result(pages[0][1]).text_content.full_text == pages[0][1]
+
+    reloaded = PageIndex(str(tmp_path))
+    assert reloaded.stats()["indexed_pages"] == 50
+    assert_all_found(reloaded, pages)
+
+def test_reload_truncates_partial_rows(tmp_path):
+    rng = np.random.default_rng(1)
+    pages = add_pages(PageIndex(str(tmp_path)), rng, 2)
+
+    # A writer that crashed after appending the id and part of the fingerprint
+    with open(tmp_path / "ids.bin", "ab") as f:
+        f.write(uuid.uuid4().bytes)
+    with open(tmp_path / "fine.bin", "ab") as f:
+        f.write(b"\x00" * 50)
+
+    index = PageIndex(str(tmp_path))
+    assert os.path.getsize(tmp_path / "ids.bin") == 2 * 16
+    assert os.path.getsize(tmp_path / "fine.bin") == 2 * PerceptualHash.FINE_BYTES
+    pages += add_pages(index, rng, 1)
+    assert_all_found(index, pages)
+    assert_all_found(PageIndex(str(tmp_path)), pages)
+
+def test_partial_fine_row_does_not_break_lookup(tmp_path):
+    rng = np.random.default_rng(2)
+    index = PageIndex(str(tmp_path))
+    pages = add_pages(index, rng, 3)
+    with open(tmp_path / "fine.bin", "ab") as f:
+        f.write(b"\x00" * 50)
+    assert_all_found(index, pages)
+
+def test_instances_sharing_a_directory_stay_aligned(tmp_path):
+    rng = np.random.default_rng(3)
+    first, second = PageIndex(str(tmp_path)), PageIndex(str(tmp_path))
+    pages = []
+    for _ in range(5):
+        pages += add_pages(first, rng, 2)
+        pages += add_pages(second, rng, 1)
+    assert_all_found(first, pages)
+    assert_all_found(second, pages)
+
+def _add_in_process(storage_dir: str, seed: int, count: int, queue):
+    pages = add_pages(PageIndex(storage_dir), np.random.default_rng(seed), count)
+    queue.put([(fp.coarse, fp.fine, document_id) for fp, document_id in pages])
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_concurrent_processes_stay_aligned(tmp_path):
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    workers = [ctx.Process(target=_add_in_process, args=(str(tmp_path), seed, 100, queue)) for seed in (10, 11)]
+    for worker in workers:
+        worker.start()
+    pages = [(PageFingerprint(coarse, fine), document_id) for _ in workers for coarse, fine, document_id in queue.get()]
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+
+    index = PageIndex(str(tmp_path))
+    assert index.stats()["indexed_pages"] == 200
+    assert_all_found(index, pages)
+
+def test_detail_check_rejects_a_changed_field(tmp_path):
+    rng = random.Random(4)
+    index = PageIndex(str(tmp_path))
+    pages = [(make_page(rng, 0, values_seed), uuid.uuid4().hex) for values_seed in (100, 101)]
+    for page, document_id in pages:
+        index.add(PageFingerprint.from_image(page), make_response(document_id))
+
+    for (page, document_id), values_seed in zip(pages, (100, 101)):
+        match = index.lookup(PageFingerprint.from_image(rescan(rng, page)))
+        assert match is not None and match.document_id == document_id
+        edited = make_page(rng, 0, values_seed, edited_line=3)
+        assert index.lookup(PageFingerprint.from_image(rescan(rng, edited))) is None
+    assert index.stats()["detail_rejections"] >= 2
+
+def test_pages_without_a_stored_detail_image_are_not_reused(tmp_path):
+    page = make_page(random.Random(5), 1, 200)
+    index = PageIndex(str(tmp_path))
+    fingerprint = PageFingerprint.from_image(page)
+    index.add(PageFingerprint(fingerprint.coarse, fingerprint.fine), make_response(uuid.uuid4().hex))
+    assert index.lookup(fingerprint) is None
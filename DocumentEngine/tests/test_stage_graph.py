@@ -0,0 +1,187 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from app.models.schema import StageStatus
+from app.services.stage_graph import Stage, StageGraph, StageFailedError, UnknownStageError
+
+@pytest.fixture(autouse=True)
+def executor(monkeypatch):
+    """A fresh pool per test, so stages abandoned by one test cannot hold workers in the next."""
+    pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="test-stage")
+    monkeypatch.setattr(StageGraph, "_executor", pool)
+    yield pool
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def sleeper(seconds: float, value=None):
+    def run(ctx):
+        time.sleep(seconds)
+        return value
+    return run
+
+def fail(ctx):
+    raise RuntimeError("boom")
+
+def statuses(result):
+    return {report.name: report.status for report in result.reports}
+
+def test_dependencies_receive_outputs_and_independent_stages_overlap():
+    graph = StageGraph([
+        Stage("a", lambda ctx: ctx["seed"] + 1),
+        Stage("b", lambda ctx: time.sleep(0.2) or ctx["a"] * 10, depends_on=("a",)),
+        Stage("c", lambda ctx: time.sleep(0.2) or ctx["a"] * 100, depends_on=("a",)),
+        Stage("d", lambda ctx: ctx["b"] + ctx["c"], depends_on=("b", "c")),
+    ])
+    start = time.time()
+    result = graph.run({"seed": 1})
+    assert time.time() - start < 0.35
+    assert result.outputs["d"] == 220
+    assert set(statuses(result).values()) == {StageStatus.OK}
+    assert not result.degraded
+
+def test_failed_stage_skips_only_its_dependents():
+    graph = StageGraph([
+        Stage("a", fail),
+        Stage("b", lambda ctx: 1, depends_on=("a",)),
+        Stage("c", lambda ctx: 2),
+    ])
+    result = graph.run({})
+    assert statuses(result) == {"a": StageStatus.FAILED, "b": StageStatus.SKIPPED, "c": StageStatus.OK}
+    assert result.degraded
+
+def test_required_stage_failure_raises():
+    graph = StageGraph([Stage("a", fail, required=True)])
+    with pytest.raises(StageFailedError) as exc:
+        graph.run({})
+    assert exc.value.stage == "a" and not exc.value.timed_out
+
+def test_required_stage_skipped_by_failed_dependency_raises():
+    graph = StageGraph([
+        Stage("deskew", fail),
+        Stage("enhance", lambda ctx: 1, depends_on=("deskew",)),
+        Stage("ocr", lambda ctx: 2, depends_on=("enhance",), required=True),
+    ])
+    with pytest.raises(StageFailedError) as exc:
+        graph.run({})
+    assert exc.value.stage == "ocr" and not exc.value.timed_out
+
+def test_required_stage_skipped_by_timed_out_dependency_is_a_timeout():
+    graph = StageGraph([
+        Stage("deskew", sleeper(1.0), timeout_s=0.1),
+        Stage("ocr", lambda ctx: 2, depends_on=("deskew",), required=True),
+    ])
+    with pytest.raises(StageFailedError) as exc:
+        graph.run({})
+    assert exc.value.stage == "ocr" and exc.value.timed_out
+
+def test_stage_timeout_abandons_stage():
+    graph = StageGraph([Stage("slow", sleeper(1.0), timeout_s=0.1), Stage("after", lambda ctx: 1, depends_on=("slow",))])
+    start = time.time()
+    result = graph.run({})
+    assert time.time() - start < 0.5
+    assert statuses(result) == {"slow": StageStatus.TIMEOUT, "after": StageStatus.SKIPPED}
+
+def test_timeout_starts_when_the_stage_runs(executor):
+    # Other requests hold every worker for 0.3s; the queued stage must not time out while it waits
+    for _ in range(4):
+        executor.submit(time.sleep, 0.3)
+    graph = StageGraph([Stage("a", sleeper(0.05, "done"), timeout_s=0.2)])
+    result = graph.run({})
+    assert statuses(result) == {"a": StageStatus.OK}
+    assert result.outputs["a"] == "done"
+    assert result.reports[0].runtime_ms < 200
+
+def test_queued_stage_is_dropped_at_the_deadline(executor):
+    for _ in range(4):
+        executor.submit(time.sleep, 0.5)
+    graph = StageGraph([Stage("a", sleeper(0.01))])
+    start = time.time()
+    result = graph.run({}, deadline=time.time() + 0.1)
+    assert time.time() - start < 0.3
+    assert statuses(result) == {"a": StageStatus.TIMEOUT}
+    assert "queued" in result.reports[0].error
+
+def test_deadline_caps_stage_timeout():
+    graph = StageGraph([Stage("slow", sleeper(1.0), timeout_s=10)])
+    start = time.time()
+    result = graph.run({}, deadline=time.time() + 0.1)
+    assert time.time() - start < 0.4
+    assert statuses(result) == {"slow": StageStatus.TIMEOUT}
+
+def test_disabled_stage_propagates_without_failing_required_dependents():
+    graph = StageGraph([
+        Stage("a", lambda ctx: 1),
+        Stage("b", lambda ctx: 2, depends_on=("a",), required=True),
+    ])
+    result = graph.run({}, enabled={"b"})
+    assert statuses(result) == {"a": StageStatus.DISABLED, "b": StageStatus.DISABLED}
+    assert not result.degraded
+
+def test_condition_bypasses_stage_and_its_dependents():
+    graph = StageGraph([
+        Stage("a", lambda ctx: None),
+        Stage("b", lambda ctx: 1, depends_on=("a",), condition=lambda ctx: ctx["a"] is not None, required=True),
+        Stage("c", lambda ctx: 2, depends_on=("b",)),
+    ])
+    result = graph.run({})
+    assert statuses(result) == {"a": StageStatus.OK, "b": StageStatus.BYPASSED, "c": StageStatus.BYPASSED}
+    assert not result.degraded
+
+def test_optional_dependency_failure_does_not_block():
+    graph = StageGraph([
+        Stage("match", fail),
+        Stage("fallback", lambda ctx: "full page", optional_depends_on=("match",),
+              condition=lambda ctx: ctx.get("match") is None),
+        Stage("fields", lambda ctx: "fields", optional_depends_on=("match",),
+              condition=lambda ctx: ctx.get("match") is not None, required=True),
+    ])
+    result = graph.run({})
+    assert statuses(result) == {"match": StageStatus.FAILED, "fallback": StageStatus.OK, "fields": StageStatus.BYPASSED}
+    assert result.outputs["fallback"] == "full page"
+
+def test_max_parallel_runs_stages_one_at_a_time():
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def tracked(ctx):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+
+    graph = StageGraph([Stage(name, tracked) for name in "abcd"])
+    result = graph.run({}, max_parallel=1)
+    assert peak[0] == 1
+    assert set(statuses(result).values()) == {StageStatus.OK}
+
+def test_resolve_enabled():
+    graph = StageGraph([
+        Stage("a", lambda ctx: 1),
+        Stage("b", lambda ctx: 2, depends_on=("a",)),
+        Stage("extra", lambda ctx: 3, depends_on=("b",), enabled_by_default=False),
+    ])
+    assert graph.resolve_enabled() == {"a", "b"}
+    assert graph.resolve_enabled(disable=["b"]) == {"a"}
+    assert graph.resolve_enabled(enable=["extra"], disable=["a"]) == {"b", "extra"}
+    with pytest.raises(UnknownStageError):
+        graph.resolve_enabled(enable=["nope"])
+
+@pytest.mark.parametrize("stages", [
+    [Stage("a", fail), Stage("a", fail)],
+    [Stage("a", fail, depends_on=("missing",))],
+    [Stage("a", fail, depends_on=("b",)), Stage("b", fail, depends_on=("a",))],
+])
+def test_invalid_graphs_are_rejected(stages):
+    with pytest.raises(ValueError):
+        StageGraph(stages)
+
+def test_stages_cut_off_by_the_deadline_time_out():
+    graph = StageGraph([
+        Stage("deskew", sleeper(1.0)),
+        Stage("enhance", lambda ctx: 1, depends_on=("deskew",)),
+        Stage("tables", lambda ctx: 2, depends_on=("deskew",)),
+    ])
+    result = graph.run({}, deadline=time.time() + 0.1)
+    assert statuses(result) == {"deskew": StageStatus.TIMEOUT, "enhance": StageStatus.TIMEOUT, "tables": StageStatus.TIMEOUT}
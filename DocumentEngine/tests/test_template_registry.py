@@ -0,0 +1,28 @@
+import random
+import pytest
+from benchmarks.bench_template_ocr import make_form, fill_and_rescan, make_text_page
+from app.services.template_registry import TemplateRegistry
+
+@pytest.fixture(scope="module")
+def forms():
+    return [make_form(k) for k in range(8)]
+
+def test_rescanned_pages_match_their_template(forms):
+    registry = TemplateRegistry()
+    ids = [registry.register(f"form-{k}", form, fields).template_id for k, (form, fields) in enumerate(forms)]
+    rng = random.Random(0)
+    for k in (0, 3, 7):
+        match = registry.match(fill_and_rescan(rng, *forms[k]))
+        assert match is not None and match.template.template_id == ids[k]
+    assert registry.match(make_text_page(rng)) is None
+
+def test_registries_sharing_a_directory_stay_in_sync(tmp_path, forms):
+    first, second = TemplateRegistry(str(tmp_path)), TemplateRegistry(str(tmp_path))
+    info = first.register("form-0", *forms[0])
+    assert [t.template_id for t in second.list_templates()] == [info.template_id]
+    match = second.match(fill_and_rescan(random.Random(1), *forms[0]))
+    assert match is not None and match.template.template_id == info.template_id
+
+    assert second.remove(info.template_id)
+    assert first.list_templates() == []
+    assert TemplateRegistry(str(tmp_path)).list_templates() == []